@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# benchmark: routine_runner and monitor_agent against the local stand-ins in
+# bench/standins.py, printing JSON so runs can be compared
+#
+#   python bench/agent_bench.py [--containers 10,100,1000] [--duration 20] [--output res.json]
+#
+# every scenario runs in its own process so memory and threads are its own
+
+import sys
+sys.path.append('lib/')
+sys.path.append('.')
+import os
+import json
+import time
+import types
+import argparse
+import resource
+import platform
+import threading
+import subprocess
+import ss_utils
+import standins
+
+# tasks of the routine every container runs
+ROUTINE = [
+    {
+        'name': 'status',
+        'description': 'GET the service status',
+        'request': {'method': 'GET', 'uri': '/status'},
+        'response': {'expected-status': '200', 'expected-response-field': 'status', 'expected-response-field-value': 'ok'}
+    },
+    {
+        'name': 'items',
+        'description': 'GET the item list a few times at once',
+        'instances': 5,
+        'concurrency': 5,
+        'request': {'method': 'GET', 'uri': '/items'},
+        'response': {'expected-status': '200', 'expected-response-field': 'items/*/status', 'expected-response-field-value': 'ok'}
+    },
+    {
+        'name': 'create',
+        'description': 'POST an item once the service is up',
+        'depends-on': 'status',
+        'request': {'method': 'POST', 'uri': '/items', 'data': '{"name": "bench"}'},
+        'response': {'expected-status': '200-299', 'warning-threshold': 1, 'critical-threshold': 5}
+    }
+]
+
+def rss_mb():
+    """Current resident memory, from /proc where there is one"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except IOError:
+        pass
+    return None
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, bytes on mac
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+class Recorder(object):
+    """Wraps a routine runner, keeping routine latency and task counts"""
+
+    def __init__(self, run):
+        self.run = run
+        self.lock = threading.Lock()
+        self.latency = ss_utils.Histogram()
+        self.routines = 0
+        self.tasks = 0
+        self.tasks_failed = 0
+
+    def __call__(self, *args):
+        start = ss_utils.monotonic()
+        res = self.run(*args)
+        elapsed = ss_utils.monotonic() - start
+        with self.lock:
+            self.latency.record(elapsed * 1000000)
+            self.routines += 1
+            self.tasks += len(res['task-results'])
+            self.tasks_failed += res['tasks-failed']
+        return res
+
+    def results(self, seconds):
+        return {
+            'routines-per-sec': round(self.routines / seconds, 1),
+            'tasks-per-sec': round(self.tasks / seconds, 1),
+            'tasks-failed': self.tasks_failed,
+            'routine-latency-ms': self.latency.summary(scale=1000)
+            }
+
+def sample(seconds, stats):
+    """Sleep for seconds, keeping the most threads and memory seen"""
+    end = time.time() + seconds
+    while time.time() < end:
+        stats['threads-max'] = max(stats.get('threads-max', 0), threading.active_count())
+        stats['rss-mb-max'] = max(stats.get('rss-mb-max', 0), rss_mb())
+        time.sleep(min(1, max(end - time.time(), 0)))
+
+def bench_runner(args):
+    """Runner alone: concurrency threads running the routine back to back"""
+
+    import routine_runner
+    routine_runner.LOG_LEVEL = 0
+    target = standins.start_target(args.latency, args.size)
+    routine = routine_runner.Routine({'name': 'bench', 'tasks': ROUTINE})
+    host_set = routine_runner.HostSet({'name': 'bench', 'hosts': [{'name': 'target', 'hostname': '127.0.0.1', 'port': target.server_port}]})
+    recorder = Recorder(lambda: routine_runner.Runner(routine, host_set).run())
+    done = threading.Event()
+
+    def loop():
+        while not done.isSet():
+            recorder()
+
+    for i in range(args.concurrency):
+        t = threading.Thread(target=loop)
+        t.daemon = True
+        t.start()
+    stats = {'scenario': 'runner', 'concurrency': args.concurrency, 'duration-sec': args.duration}
+    start = time.time()
+    sample(args.duration, stats)
+    done.set()
+    stats.update(recorder.results(time.time() - start))
+    return stats
+
+def bench_agent(args):
+    """The agent loop for a host with args.containers containers, each checked every args.interval seconds"""
+
+    docker = types.ModuleType('docker')
+    docker.client = types.ModuleType('docker.client')
+    docker.client.Client = standins.FakeDockerClient
+    sys.modules['docker'] = docker
+    sys.modules['docker.client'] = docker.client
+    import routine_runner
+    import monitor_agent as ma
+    routine_runner.LOG_LEVEL = 0
+    ma.log = ma.debug = lambda msg: None
+
+    target = standins.start_target(args.latency, args.size)
+    sensu, sensu_state = standins.start_sensu()
+    content = json.dumps(ROUTINE)
+    ma.DEFAULT_PORT = target.server_port
+    ma.CLI = standins.FakeDockerClient(args.containers)
+    ma.CFG = {
+        'frequencies': [{'pattern': '.*', 'seconds': args.interval}],
+        'routine-file': '/etc/devops/monitor.json',
+        'scheduler': {'workers': args.workers, 'jitter': 0.1}
+        }
+    ma.FREQUENCIES = ma.FrequencyRules(ma.CFG['frequencies'])
+    ma.CONTAINERS_LOCK = threading.RLock()
+    ma.CONTAINER_IDS = {}
+    ma.HOSTNAME = 'bench-host'
+    ma.ENV = 'bench'
+    ma.ROUTINE_CACHE = ma.RoutineCache(lambda container_obj: content)
+    ma.BREAKER = ma.configure_breaker(ss_utils.CircuitBreaker(), ma.CFG)
+    ma.SCHEDULER = ma.make_scheduler()
+    ma.SCHEDULER.start()
+    ma.server_conn = ss_utils.RestHelper('127.0.0.1', sensu.server_port, secure=False)
+    ma.RESULTS = ss_utils.CoalescingQueue(max(1000, args.containers))
+    for i in range(2):
+        t = threading.Thread(target=ma.send_results)
+        t.daemon = True
+        t.start()
+    recorder = Recorder(ma.run_routine)
+    ma.run_routine = recorder
+
+    stats = {'scenario': 'agent', 'containers': args.containers, 'interval-sec': args.interval, 'duration-sec': args.duration}
+    start = ss_utils.monotonic()
+    ma.update()
+    stats['first-update-ms'] = round((ss_utils.monotonic() - start) * 1000, 1)
+    start = ss_utils.monotonic()
+    ma.update()
+    stats['update-ms'] = round((ss_utils.monotonic() - start) * 1000, 1)
+
+    start = time.time()
+    sample(args.duration, stats)
+    elapsed = time.time() - start
+    stats.update(recorder.results(elapsed))
+    stats['results-posted-per-sec'] = round(sensu_state.results / elapsed, 1)
+    stats['result-queue'] = ma.RESULTS.stats()
+    stats['scheduler'] = ma.SCHEDULER.stats()
+    stats['clients'] = len(sensu_state.clients)
+    stats['peak-rss-mb'] = peak_rss_mb()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark routine_runner and monitor_agent against local stand-ins')
+    parser.add_argument('--scenario', choices=['all', 'runner', 'agent'], default='all')
+    parser.add_argument('--containers', default='10,100,1000', help='comma separated container counts for the agent scenario')
+    parser.add_argument('--duration', type=float, default=20, help='seconds each scenario is measured for')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between checks of a container')
+    parser.add_argument('--workers', type=int, default=8, help='scheduler workers of the agent')
+    parser.add_argument('--concurrency', type=int, default=4, help='routines run at once by the runner scenario')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the http target takes to answer')
+    parser.add_argument('--size', type=int, default=2048, help='bytes in an http target response')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    if args.scenario == 'runner':
+        print(json.dumps(bench_runner(args)))
+        os._exit(0)
+    if args.scenario == 'agent':
+        args.containers = int(args.containers)
+        print(json.dumps(bench_agent(args)))
+        # sender and scheduler threads never exit on their own
+        os._exit(0)
+
+    common = ['--duration', str(args.duration), '--interval', str(args.interval), '--workers', str(args.workers),
+              '--concurrency', str(args.concurrency), '--latency', str(args.latency), '--size', str(args.size)]
+    runs = [ ['--scenario', 'runner'] ] + [ ['--scenario', 'agent', '--containers', n] for n in args.containers.split(',') ]
+    scenarios = []
+    for run in runs:
+        sys.stderr.write('running ' + ' '.join(run) + '\n')
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + run + common)
+        scenarios.append(json.loads(out.strip().splitlines()[-1]))
+
+    res = {
+        'timestamp': ss_utils.get_current_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'params': dict([ (k, v) for k, v in vars(args).items() if k not in ('scenario', 'output') ]),
+        'scenarios': scenarios
+        }
+    out = json.dumps(res, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
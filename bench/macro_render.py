@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# micro-benchmark: cost of expanding the macros of one http task (uri, data, auth
+# and expected value) with the old regex + str.replace approach vs compiled templates
+
+import sys
+sys.path.append('lib/')
+sys.path.append('.')
+import re
+import json
+import timeit
+import routine_runner
+
+ITERATIONS = 20000
+
+TASK = {
+    'name': 'get-user',
+    'description': 'GET the user created by an earlier task',
+    'request': {
+        'method': 'GET',
+        'uri': '/users/<task:create-user:id>/profile?session=<task:login:token>',
+        'auth': 'Bearer <task:login:token>',
+        'data': '{"name": "<general:rand_string>", "role": "tester"}'
+    },
+    'response': {
+        'expected-status': '200',
+        'expected-response-field': 'name',
+        'expected-response-field-value': '<general:rand_string>'
+    }
+}
+
+def legacy_expand(runtime, string):
+    """Runtime.expand_macros before templates were compiled, debug logging included"""
+    log = routine_runner.log
+    log('expanding string: ' + string, 2)
+    res = string
+    matcher = re.compile(r'<\w+:[\w\:]+>')
+    for macro in matcher.findall(string):
+        log('replacing macro ' + macro, 2)
+        chunks = macro[1:-1].split(':')
+        expanded = runtime.expand_macro(chunks[0], chunks[1], chunks[2:])
+        log('expanding macro to: ' + expanded, 2)
+        res = res.replace(macro, expanded)
+    log('string expanded to: ' + res, 2)
+    return res
+
+def main():
+    routine_runner.LOG_LEVEL = 0
+    task = routine_runner.http(TASK)
+    runtime = routine_runner.Runtime()
+    runtime.snapshot = {'create-user': {'id': '12345'}, 'login': {'token': 'abcdef0123456789'}}
+    runtime.macros['rand_string'] = 'user20160101000000000000'
+
+    strings = [task.uri, task.data, task.auth, task.expected_response_value]
+    templates = task.macro_templates()
+    assert [ legacy_expand(runtime, s) for s in strings ] == [ t.render(runtime) for t in templates ]
+
+    legacy = min(timeit.repeat(lambda: [ legacy_expand(runtime, s) for s in strings ], number=ITERATIONS, repeat=3))
+    compiled = min(timeit.repeat(lambda: [ t.render(runtime) for t in templates ], number=ITERATIONS, repeat=3))
+    res = {
+        'iterations': ITERATIONS,
+        'legacy-us-per-task': round(legacy / ITERATIONS * 1000000, 3),
+        'compiled-us-per-task': round(compiled / ITERATIONS * 1000000, 3),
+        'speedup': round(legacy / compiled, 2)
+        }
+    print(json.dumps(res, indent=4))
+
+if __name__ == '__main__':
+    main()
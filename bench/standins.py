@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# local stand-ins for the things the agent talks to, used by the benchmarks:
+# an http target for routines, a sensu-style server and a docker client
+
+import json
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, like the real services
+    protocol_version = 'HTTP/1.1'
+    # a response written in pieces would wait on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else ''
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _serve(handler):
+    server = _Server(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=server.serve_forever, name='standin-' + handler.__name__)
+    t.daemon = True
+    t.start()
+    return server
+
+def start_target(latency=0.0, size=256):
+    """An http target answering every request after latency seconds with size bytes of
+    JSON like {"status": "ok", "items": [...], "padding": "..."}"""
+
+    items = [ {'id': i, 'status': 'ok'} for i in range(10) ]
+    body = json.dumps({'status': 'ok', 'items': items, 'padding': ''})
+    body = json.dumps({'status': 'ok', 'items': items, 'padding': 'x' * max(size - len(body), 0)})
+
+    class Target(_Handler):
+        def handle_any(self):
+            self.read_body()
+            if latency:
+                time.sleep(latency)
+            self.reply(200, body)
+        do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+    return _serve(Target)
+
+class SensuState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.results = 0
+        self.statuses = {}
+
+def start_sensu():
+    """A sensu-style server keeping clients in memory and counting posted results,
+    returns (server, state)"""
+
+    state = SensuState()
+
+    class Sensu(_Handler):
+        def do_GET(self):
+            with state.lock:
+                body = json.dumps(state.clients.values())
+            self.reply(200, body)
+
+        def do_POST(self):
+            data = json.loads(self.read_body())
+            with state.lock:
+                if self.path == '/clients':
+                    state.clients[data['name']] = data
+                else:
+                    state.results += 1
+                    state.statuses[data['status']] = state.statuses.get(data['status'], 0) + 1
+            self.reply(201, '{}')
+
+        def do_DELETE(self):
+            with state.lock:
+                state.clients.pop(self.path.split('/')[-1], None)
+            self.reply(202, '{}')
+
+    return _serve(Sensu), state
+
+class FakeDockerClient(object):
+    """The docker-py calls monitor_agent makes for a host running n containers named bench-0..n-1"""
+
+    def __init__(self, n=0, base_url=None):
+        self.running = dict([ ('%064x' % i, 'bench-' + str(i)) for i in range(n) ])
+
+    def info(self):
+        return {'Name': 'bench-host'}
+
+    def containers(self, filters=None):
+        containers = [ {'Id': i, 'Names': ['/' + name]} for i, name in sorted(self.running.items()) ]
+        if filters and 'id' in filters:
+            containers = [ c for c in containers if c['Id'] == filters['id'] ]
+        return containers
+
+    def inspect_container(self, container):
+        return {'NetworkSettings': {'IPAddress': '127.0.0.1'}}
+
+    def events(self, filters=None, decode=False):
+        return iter([])
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# micro-benchmark: looking fields up in a large decoded response with the old
+# interpreted xpath_get (split and int() on every call) vs compiled xpaths
+
+import sys
+sys.path.append('lib/')
+import json
+import timeit
+import ss_utils
+
+ITERATIONS = 20000
+ITEMS = 5000
+
+PATHS = ['meta/page/size', 'items/4999/status', 'items/0/owner/name']
+
+def legacy_xpath_get(mydict, path):
+    """ss_utils.xpath_get before paths were compiled"""
+    elem = mydict
+    try:
+        for x in path.strip("/").split("/"):
+            try:
+                x = int(x)
+                elem = elem[x]
+            except ValueError:
+                elem = elem.get(x)
+    except:
+        pass
+    return elem
+
+def legacy_all_ok(doc):
+    """what a check over items/*/status needed before wildcards, done in python by hand"""
+    return all([ legacy_xpath_get(item, 'status') == 'ok' for item in legacy_xpath_get(doc, 'items') ])
+
+def main():
+    doc = {
+        'meta': {'page': {'size': ITEMS, 'number': 1}},
+        'items': [ {'id': i, 'status': 'ok', 'owner': {'name': 'user' + str(i)}} for i in range(ITEMS) ]
+        }
+    xpaths = [ ss_utils.compile_xpath(path) for path in PATHS ]
+    assert [ legacy_xpath_get(doc, path) for path in PATHS ] == [ xpath.get(doc) for xpath in xpaths ]
+
+    legacy = min(timeit.repeat(lambda: [ legacy_xpath_get(doc, path) for path in PATHS ], number=ITERATIONS, repeat=3))
+    compiled = min(timeit.repeat(lambda: [ xpath.get(doc) for xpath in xpaths ], number=ITERATIONS, repeat=3))
+
+    wildcard = ss_utils.compile_xpath('items/*/status')
+    assert legacy_all_ok(doc)
+    legacy_scan = min(timeit.repeat(lambda: legacy_all_ok(doc), number=20, repeat=3))
+    compiled_scan = min(timeit.repeat(lambda: all([ v == 'ok' for v in wildcard.get(doc) ]), number=20, repeat=3))
+    res = {
+        'iterations': ITERATIONS,
+        'legacy-us-per-lookup': round(legacy / ITERATIONS / len(PATHS) * 1000000, 3),
+        'compiled-us-per-lookup': round(compiled / ITERATIONS / len(PATHS) * 1000000, 3),
+        'speedup': round(legacy / compiled, 2),
+        'legacy-ms-per-collection-check': round(legacy_scan / 20 * 1000, 3),
+        'wildcard-ms-per-collection-check': round(compiled_scan / 20 * 1000, 3)
+        }
+    print(json.dumps(res, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,258 @@
 import httplib
 import ssl
+import socket
 import json
 import subprocess
 import time
 import datetime
 import threading
-import csv
+import Queue
+import heapq
+import random
+import traceback
+import array
+import math
+import sys
+import ctypes
+import ctypes.util
+import collections
+import re
+import shlex
+import struct
+import os
+import select
+import signal
+import BaseHTTPServer
+import bisect
+import hashlib
+import mmap
+import urlparse
+import itertools
+
+class ConnectionPool(object):
+    """Thread safe store of idle keep-alive connections, keyed by (host, port, secure, check_cert)"""
+
+    def __init__(self, max_idle=4, max_idle_time=60):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, key):
+        """Return an idle connection for key, or None if there is no fresh one"""
+        expired = []
+        conn = None
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key)
+            while conns:
+                c, last_used = conns.pop()
+                if now - last_used < self.max_idle_time:
+                    conn = c
+                    break
+                expired.append(c)
+        for c in expired:
+            c.close()
+        return conn
+
+    def put(self, key, conn):
+        """Return a connection whose last response has been fully read"""
+        expired = []
+        now = time.time()
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            # oldest connections are at the front
+            while conns and now - conns[0][1] >= self.max_idle_time:
+                expired.append(conns.pop(0)[0])
+            if len(conns) < self.max_idle:
+                conns.append((conn, now))
+            else:
+                expired.append(conn)
+        for c in expired:
+            c.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for c, last_used in conns:
+                c.close()
+
+# shared by every RestHelper unless one is given its own pool
+CONNECTION_POOL = ConnectionPool()
+
+class RestResponse(object):
+    """Response whose body has already been read, so its connection could be reused"""
+
+    def __init__(self, resp, body):
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = dict(resp.getheaders())
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def release(self):
+        pass
+
+class _DeadlineSocket(object):
+    """Socket whose every recv times out at a deadline, so a body read in many small pieces can't outlast it"""
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.deadline = deadline
+
+    def recv(self, *args):
+        remaining = self.deadline - monotonic()
+        if remaining <= 0:
+            raise socket.timeout('timed out')
+        self.sock.settimeout(remaining)
+        return self.sock.recv(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class StreamingResponse(object):
+    """Response whose body is read by the caller, who must call release() when done with it
+
+    With a deadline (a monotonic() time), reading the body, or draining it on
+    release, raises socket.timeout once the deadline has passed.
+    """
+
+    # bytes of unread body worth reading just to keep the connection
+    DRAIN_LIMIT = 64 * 1024
+
+    def __init__(self, resp, conn, pool, pool_key, deadline=None):
+        self.status = resp.status
+        self.reason = resp.reason
+        if deadline is not None and hasattr(resp.fp, '_sock'):
+            resp.fp._sock = _DeadlineSocket(resp.fp._sock, deadline)
+        self.resp = resp
+        self.conn = conn
+        self.pool = pool
+        self.pool_key = pool_key
+
+    def read(self, amt=None):
+        return self.resp.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def release(self):
+        """Return the connection to the pool if the rest of the body is small enough to drain, else close it"""
+        if self.conn is None:
+            return
+        resp, conn, self.conn = self.resp, self.conn, None
+        try:
+            drained = 0
+            while not resp.isclosed() and drained <= self.DRAIN_LIMIT:
+                chunk = resp.read(8192)
+                if not chunk:
+                    break
+                drained += len(chunk)
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            return
+        if resp.isclosed() and not resp.will_close:
+            self.pool.put(self.pool_key, conn)
+        else:
+            conn.close()
+
+def _closed_by_peer(conn):
+    """True if the server has closed an idle pooled connection, or sent on it unasked"""
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
 
 class RestHelper(object):
 
-    def __init__(self, host, port, secure, check_cert=False, auth=None):
+    # methods that can be sent again when a reused connection fails without harm if the server already got them
+    IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+    def __init__(self, host, port, secure, check_cert=False, auth=None, pool=None):
         self.host = host
         self.port = port
         self.secure = secure
         self.check_cert = check_cert
         self.auth = auth
+        self.pool = CONNECTION_POOL if pool is None else pool
+        self.pool_key = (host, port, secure, check_cert)
 
     def set_auth(self, auth):
         self.auth = auth
 
-    def request(self, method, uri, data=None, content_type='application/json', headers={}, auth='default', timeout=10):
+    def connect(self, timeout):
         if self.secure:
             if self.check_cert:
-                conn = httplib.HTTPSConnection(self.host, self.port, timeout=timeout)
+                return httplib.HTTPSConnection(self.host, self.port, timeout=timeout)
             else:
-                conn = httplib.HTTPSConnection(self.host, self.port, context=ssl._create_unverified_context(), timeout=timeout)
+                return httplib.HTTPSConnection(self.host, self.port, context=ssl._create_unverified_context(), timeout=timeout)
         else:
-            conn = httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+            return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
 
+    def request(self, method, uri, data=None, content_type='application/json', headers={}, auth='default', timeout=10, stream=False, deadline=None):
+        """Send a request, returning a RestResponse, or a StreamingResponse if stream is True
+
+        timeout applies to every socket operation, deadline (a monotonic() time)
+        to reading the whole body of a StreamingResponse.
+        """
         auth = self.auth if auth == 'default' else auth
+        headers = dict(headers)
         headers['Authorization'] = auth
         headers['Content-type'] = content_type
-        conn.request(method, uri, data, headers=headers)
-        return conn.getresponse()
+
+        idempotent = method.upper() in self.IDEMPOTENT
+        conn = self.pool.get(self.pool_key)
+        if conn is not None and not idempotent and _closed_by_peer(conn):
+            # a request that can't be retried shouldn't go out on a connection the server already closed
+            conn.close()
+            conn = None
+        reused = conn is not None
+        while 1:
+            if conn is None:
+                conn = self.connect(timeout)
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            sent = False
+            try:
+                conn.request(method, uri, data, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                break
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # once sent, the server may have acted on a request, so only an idempotent one is sent again
+                if not reused or (sent and not idempotent):
+                    raise
+                # the server closed the idle connection, retry once on a new one
+                conn, reused = None, False
+
+        if stream:
+            return StreamingResponse(resp, conn, self.pool, self.pool_key, deadline)
+
+        # read the whole body so the connection can go back into the pool
+        try:
+            body = resp.read()
+        except:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(self.pool_key, conn)
+        return RestResponse(resp, body)
 
 class TaskTimer(threading.Thread):
     """Thread that executes a task every N seconds"""
@@ -48,6 +268,10 @@ class TaskTimer(threading.Thread):
     def shutdown(self):
         """Stop this thread"""
         self._finished.set()
+
+    def set_interval(self, interval):
+        """Run every interval seconds from the next run on"""
+        self._interval = interval
     
     def run(self):
         while 1:
@@ -57,53 +281,1334 @@ class TaskTimer(threading.Thread):
             # sleep for interval or until shutdown
             self._finished.wait(self._interval)
 
+class ScheduledTask(object):
+    """Bookkeeping for a task registered with a Scheduler"""
+
+    __slots__ = ('key', 'interval', 'task', 'args', 'kargs', 'base', 'due', 'version', 'pending', 'lag', 'runs', 'overruns')
+
+    def __init__(self, key, interval, task, args, kargs):
+        self.key = key
+        self.interval = interval
+        self.task = task
+        self.args = args
+        self.kargs = kargs
+        self.base = None        # nominal time of the next run
+        self.due = None         # base plus jitter
+        self.version = 0        # bumped to invalidate entries already in the heap
+        self.pending = False    # handed to the worker pool and not finished yet
+        self.lag = None         # seconds between due time and actual start of the last run
+        self.runs = 0
+        self.overruns = 0
+
+class Scheduler(object):
+    """Executes many tasks, each every N seconds, on a fixed pool of worker threads
+
+    Next run times are kept in a heap that a single dispatcher thread drains into
+    a work queue, so the number of threads does not grow with the number of tasks.
+    A task is not queued again until its previous run has finished.
+    """
+
+    def __init__(self, workers=4, jitter=0.1):
+        self.workers = workers
+        self.jitter = jitter
+        self._cond = threading.Condition()
+        self._finished = threading.Event()
+        self._heap = []
+        self._seq = 0
+        self._tasks = {}
+        self._queue = Queue.Queue()
+        self._threads = []
+        self.overruns = 0   # runs that took longer than their interval, tasks canceled since included
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._dispatch, name='scheduler'))
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._work, name='worker-' + str(i)))
+        for t in self._threads:
+            t.start()
+
+    def shutdown(self):
+        """Stop dispatching and let workers exit once their current task is done"""
+        self._finished.set()
+        with self._cond:
+            self._cond.notify()
+        for t in self._threads:
+            self._queue.put(None)
+
+    def __contains__(self, key):
+        return key in self._tasks
+
+    def get_interval(self, key):
+        return self._tasks[key].interval
+
+    def schedule(self, key, interval, task, *args, **kargs):
+        with self._cond:
+            if key in self._tasks:
+                raise ValueError('task already scheduled: ' + str(key))
+            st = ScheduledTask(key, interval, task, args, kargs)
+            self._tasks[key] = st
+            # spread first runs over one interval so tasks added together don't fire together
+            self._push(st, time.time() + random.uniform(0, interval))
+
+    def reschedule(self, key, interval):
+        """Change the interval of a scheduled task, keeping its place in the current cycle"""
+        with self._cond:
+            st = self._tasks[key]
+            if st.interval == interval:
+                return
+            base = st.base - st.interval + interval
+            st.interval = interval
+            # a running task picks up the new interval when it finishes
+            if not st.pending:
+                self._push(st, base)
+
+    def cancel(self, key):
+        """Remove a task; a run already in progress is allowed to finish"""
+        with self._cond:
+            st = self._tasks.pop(key, None)
+            if st is None:
+                return False
+            st.version += 1
+            return True
+
+    def stats(self):
+        """Summary of how far behind schedule tasks are running (lag in seconds)"""
+        with self._cond:
+            tasks = self._tasks.values()
+            lags = [ st.lag for st in tasks if st.lag is not None ]
+            return {
+                'tasks': len(tasks),
+                'workers': self.workers,
+                'pending': len([ st for st in tasks if st.pending ]),
+                'queued': self._queue.qsize(),
+                'overruns': self.overruns,
+                'max-lag': round(max(lags), 3) if lags else 0,
+                'avg-lag': round(sum(lags) / len(lags), 3) if lags else 0
+                }
+
+    def _push(self, st, base):
+        # caller must hold self._cond
+        st.version += 1
+        st.base = base
+        st.due = base + random.uniform(0, self.jitter * st.interval)
+        self._seq += 1
+        heapq.heappush(self._heap, (st.due, self._seq, st.key, st.version))
+        self._cond.notify()
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._finished.isSet():
+                if not self._heap:
+                    self._cond.wait(1)
+                    continue
+                due, seq, key, version = self._heap[0]
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                st = self._tasks.get(key)
+                if st is None or st.version != version:
+                    # cancelled or rescheduled since this entry was pushed
+                    continue
+                st.pending = True
+                self._queue.put(st)
+
+    def _work(self):
+        while 1:
+            st = self._queue.get()
+            if st is None: return
+            start = time.time()
+            st.lag = start - st.due
+            try:
+                st.task(*st.args, **st.kargs)
+            except:
+                traceback.print_exc()
+            end = time.time()
+
+            with self._cond:
+                st.pending = False
+                st.runs += 1
+                if self._tasks.get(st.key) is not st:
+                    continue
+                base = st.base + st.interval
+                if base < end:
+                    # run took longer than its interval, start the next cycle from now instead of catching up
+                    st.overruns += 1
+                    self.overruns += 1
+                    base = end
+                self._push(st, base)
+
+class CoalescingQueue(object):
+    """Bounded FIFO queue that holds at most one item per key
+
+    Putting an item for a key that is already queued replaces the queued item
+    in place, so only the newest one is delivered. When the queue is full the
+    oldest item is dropped to make room for the new one, and on_drop, if
+    given, is called with its key.
+    """
+
+    def __init__(self, maxsize=1000, on_drop=None):
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._items = collections.OrderedDict()
+
+    def put(self, key, item, replace=True, evict=True):
+        """Queue item under key; with replace=False an item already queued for key is kept instead
+
+        replace may also be a function of the queued item, saying whether to replace it.
+        With evict=False a full queue drops item itself rather than its oldest item.
+        """
+        dropped = None
+        with self._cond:
+            if key in self._items:
+                if replace is True or (replace is not False and replace(self._items[key])):
+                    self._items[key] = item
+                    self.coalesced += 1
+                return
+            if len(self._items) >= self.maxsize:
+                self.dropped += 1
+                if evict:
+                    dropped = self._items.popitem(last=False)[0]
+                else:
+                    dropped = key
+            if dropped != key:
+                self._items[key] = item
+                self._cond.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self):
+        """Remove and return the oldest (key, item), waiting until there is one"""
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            return self._items.popitem(last=False)
+
+    def qsize(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._cond:
+            return {'queued': len(self._items), 'dropped': self.dropped, 'coalesced': self.coalesced}
+
+class CircuitBreaker(object):
+    """Backs off calls for keys that keep failing
+
+    After threshold consecutive failures the circuit of a key opens and calls
+    are refused until a delay has passed, then one trial call is let through.
+    The delay starts at the base given with the failure and doubles with every
+    further failure, up to max_delay. A success closes the circuit. A
+    threshold of 0 never opens any.
+    """
+
+    def __init__(self, threshold=3, max_delay=300):
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._failures = {}     # key -> [consecutive failures, time of next trial, last failure]
+
+    def allow(self, key):
+        """(True, None) if a call should be made, or (False, seconds until the next trial)"""
+        now = monotonic()
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None or entry[1] is None or now >= entry[1]:
+                if entry is not None and entry[1] is not None:
+                    # let one trial through, the next waits for its outcome or the same delay
+                    entry[1] = now + entry[3]
+                return True, None
+            return False, entry[1] - now
+
+    def success(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def failure(self, key, info=None, base=1):
+        """Count a failure, returning the seconds the circuit is now open for (0 if closed)"""
+        with self._lock:
+            entry = self._failures.setdefault(key, [0, None, None, 0])
+            entry[0] += 1
+            entry[2] = info
+            if not self.threshold or entry[0] < self.threshold:
+                return 0
+            entry[3] = min(base * 2 ** (entry[0] - self.threshold), self.max_delay)
+            entry[1] = monotonic() + entry[3]
+            return entry[3]
+
+    def last_failure(self, key):
+        """(consecutive failures, info given with the last one)"""
+        with self._lock:
+            entry = self._failures.get(key)
+            return (0, None) if entry is None else (entry[0], entry[2])
+
+    def forget(self, key):
+        self.success(key)
+
+    def stats(self):
+        now = monotonic()
+        with self._lock:
+            return {
+                'failing': len(self._failures),
+                'open': len([ e for e in self._failures.values() if e[1] is not None and e[1] > now ])
+                }
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes
+
+    Each node is placed at replicas points on a ring and a key belongs to the
+    next node point after its own hash, so adding or removing a node only
+    moves the keys of that node.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []   # sorted (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    def _hash(self, key):
+        return int(hashlib.md5(str(key)).hexdigest()[:12], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self._points, (self._hash(str(node) + '-' + str(i)), node))
+
+    def remove(self, node):
+        self._points = [ point for point in self._points if point[1] != node ]
+
+    def nodes(self):
+        return sorted(set([ point[1] for point in self._points ]))
+
+    def get(self, key):
+        """Node that key belongs to, or None if the ring is empty"""
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, (self._hash(key),))
+        return self._points[i % len(self._points)][1]
+
+class ThreadPool(object):
+    """Up to size daemon threads, started as calls need them and then reused
+
+    Calls submitted while every thread is busy wait their turn. A call running
+    on a pool must not wait for other calls on the same pool, or a full pool
+    deadlocks. size may be raised while the pool is in use.
+    """
+
+    def __init__(self, size, name='pool'):
+        self.size = size
+        self.name = name
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._threads = 0
+        self._idle = 0
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked, the threads stayed behind in the parent
+                self._reset()
+            self._queue.put((func, args))
+            if self._queue.qsize() > self._idle and self._threads < self.size:
+                self._threads += 1
+                self._idle += 1
+                t = threading.Thread(target=self._work, args=(self._queue,), name=self.name + '-' + str(self._threads))
+                t.daemon = True
+                t.start()
+
+    def _work(self, queue):
+        while 1:
+            func, args = queue.get()
+            with self._lock:
+                self._idle -= 1
+            try:
+                func(*args)
+            except:
+                traceback.print_exc()
+            with self._lock:
+                self._idle += 1
+
+    def stats(self):
+        with self._lock:
+            return {'threads': self._threads, 'idle': self._idle, 'queued': self._queue.qsize()}
+
+def parallel_map(func, items, concurrency, pool=None):
+    """Like map(), but calls func from up to concurrency threads at once
+
+    The threads are taken from pool (a ThreadPool) if given, else started for
+    the call. Results are returned in the order of items. If func raises, the
+    first exception is re-raised once every call has finished.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [ func(item) for item in items ]
+
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+    done = Queue.Queue()
+
+    def worker():
+        try:
+            while 1:
+                try:
+                    i, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception as e:
+                    traceback.print_exc()
+                    errors.append(e)
+        finally:
+            done.put(None)
+
+    workers = min(concurrency, len(items))
+    for n in range(workers):
+        if pool is not None:
+            pool.submit(worker)
+        else:
+            threading.Thread(target=worker).start()
+    for n in range(workers):
+        done.get()
+    if errors:
+        raise errors[0]
+    return results
+
 # shell
-def run_cmd(cmd, get_output=False):
-    cmd_list = list(csv.reader([cmd], delimiter=' ', quotechar="'", quoting=csv.QUOTE_ALL))[0]
+
+MAX_OUTPUT = 64 * 1024 # bytes kept per output stream by default
+EXEC_EXIT_WAIT = 2 # seconds an exec may still report running after its output has ended
+
+# output of a command; stdout and stderr may have had their middle cut out
+CommandOutput = collections.namedtuple('CommandOutput', ['stdout', 'stderr', 'truncated'])
+
+class CommandTimeout(Exception):
+    """Raised when a command runs past its timeout, output holds what it wrote until then"""
+
+    def __init__(self, output=None):
+        Exception.__init__(self, 'command timed out')
+        self.output = output
+
+class OutputBuffer(object):
+    """Keeps the first and the last limit/2 bytes written to it, or everything if limit is None"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.head_size = None if limit is None else limit // 2
+        self.tail_size = None if limit is None else limit - self.head_size
+        self.head = []
+        self.head_len = 0
+        self.tail = collections.deque()
+        self.tail_len = 0
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if self.limit is None:
+            self.head.append(data)
+            return
+        if self.head_len < self.head_size:
+            chunk = data[:self.head_size - self.head_len]
+            self.head.append(chunk)
+            self.head_len += len(chunk)
+            data = data[len(chunk):]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail_len > self.tail_size:
+            extra = self.tail_len - self.tail_size
+            first = self.tail[0]
+            if len(first) <= extra:
+                self.tail.popleft()
+                self.tail_len -= len(first)
+            else:
+                self.tail[0] = first[extra:]
+                self.tail_len -= extra
+
+    @property
+    def truncated(self):
+        return self.limit is not None and self.total > self.limit
+
+    def getvalue(self):
+        head = ''.join(self.head)
+        tail = ''.join(self.tail)
+        if not self.truncated:
+            return head + tail
+        return head + '\n... [' + str(self.total - self.limit) + ' bytes truncated] ...\n' + tail
+
+def _output(buffers):
+    return CommandOutput(buffers[0].getvalue(), buffers[1].getvalue(), buffers[0].truncated or buffers[1].truncated)
+
+def run_cmd(cmd, get_output=False, timeout=None, max_output=None):
+    """Run a command, returning (exit code, CommandOutput or None)
+
+    With max_output set, output is read as it is produced and only the first
+    and last max_output/2 bytes of each stream are kept. With timeout set, the
+    command's whole process group is killed after that many seconds and
+    CommandTimeout is raised.
+    """
+    cmd_list = shlex.split(cmd) if isinstance(cmd, basestring) else cmd
     stdout = subprocess.PIPE if get_output else None
     stderr = subprocess.PIPE if get_output else None
-    p = subprocess.Popen(cmd_list, stdout=stdout, stderr=stderr)
-    if get_output:
-        output = p.communicate()
-    else:
-        output = None
+    if timeout is None and max_output is None:
+        p = subprocess.Popen(cmd_list, stdout=stdout, stderr=stderr)
+        if get_output:
+            out, err = p.communicate()
+            return p.returncode, CommandOutput(out, err, False)
         p.wait()
-    return p.returncode, output
+        return p.returncode, None
 
+    # own session and process group, so anything the command spawned can be killed with it;
+    # setsid(1) rather than preexec_fn, which can deadlock a child forked from a threaded process
+    p = subprocess.Popen(['setsid'] + list(cmd_list), stdout=stdout, stderr=stderr)
+    deadline = None if timeout is None else monotonic() + timeout
+    buffers = (OutputBuffer(max_output), OutputBuffer(max_output))
+    pipes = {p.stdout.fileno(): 0, p.stderr.fileno(): 1} if get_output else {}
 
-# dicts
+    def remaining():
+        if deadline is None:
+            return None
+        left = deadline - monotonic()
+        if left <= 0:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            p.wait()
+            raise CommandTimeout(_output(buffers) if get_output else None)
+        return left
 
-def xpath_get(mydict, path):
-    elem = mydict
     try:
-        for x in path.strip("/").split("/"):
+        while pipes:
+            ready = select.select(list(pipes), [], [], remaining())[0]
+            for fd in ready:
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    buffers[pipes[fd]].write(chunk)
+                else:
+                    del pipes[fd]
+        while p.poll() is None:
+            left = remaining()
+            time.sleep(0.05 if left is None else min(left, 0.05))
+    finally:
+        for f in (p.stdout, p.stderr):
+            if f is not None:
+                f.close()
+    return p.returncode, _output(buffers) if get_output else None
+
+
+# docker
+
+def _read_exactly(sock, size, deadline):
+    """Read size bytes from sock, or fewer if it is closed first, raising CommandTimeout after deadline"""
+    chunks = []
+    while size > 0:
+        if deadline is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise CommandTimeout()
+            sock.settimeout(remaining)
+        try:
+            chunk = sock.recv(size)
+        except socket.timeout:
+            raise CommandTimeout()
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def docker_exec(cli, container, cmd, user=None, privileged=False, timeout=None, max_output=MAX_OUTPUT):
+    """Run cmd in a container over the docker API, like run_cmd(..., get_output=True) does with the CLI
+
+    Returns (exit code, CommandOutput), keeping the first and last max_output/2
+    bytes of each stream. Raises CommandTimeout if the command's output has
+    not ended after timeout seconds, or if it still hasn't exited by then (and
+    EXEC_EXIT_WAIT seconds after its output ended); the daemon has no call to
+    kill an exec, so the command itself keeps running in the container.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    exec_id = cli.exec_create(container, shlex.split(cmd), stdout=True, stderr=True, tty=False, privileged=privileged, user=user or '')
+    sock = cli.exec_start(exec_id, socket=True)
+    sock = getattr(sock, '_sock', sock)
+    buffers = (OutputBuffer(max_output), OutputBuffer(max_output))
+    try:
+        while 1:
+            # without a tty the stream is multiplexed as frames of: stream type, 3 bytes padding, payload size
+            try:
+                header = _read_exactly(sock, 8, deadline)
+                if len(header) < 8:
+                    break
+                stream, size = struct.unpack('>BxxxL', header)
+                payload = _read_exactly(sock, size, deadline)
+            except CommandTimeout:
+                raise CommandTimeout(_output(buffers))
+            buffers[1 if stream == 2 else 0].write(payload)
+    finally:
+        sock.close()
+    # the daemon may report the exec as running, without an exit code, for a moment after its output ends
+    wait_until = max(deadline, monotonic() + EXEC_EXIT_WAIT) if deadline is not None else monotonic() + EXEC_EXIT_WAIT
+    delay = 0.01
+    while 1:
+        inspect = cli.exec_inspect(exec_id)
+        if not inspect.get('Running') and inspect.get('ExitCode') is not None:
+            return inspect['ExitCode'], _output(buffers)
+        if monotonic() >= wait_until:
+            raise CommandTimeout(_output(buffers))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+# json
+
+class ResponseTooLarge(Exception):
+    pass
+
+class _AllFound(Exception):
+    pass
+
+class JsonStream(object):
+    """A JSON document read in chunks with read(n), decoded a value at a time"""
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    decoder = json.JSONDecoder()
+
+    def __init__(self, read, chunk_size=16384, max_size=None):
+        self.read = read
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+
+    def more(self, at_least=0):
+        """Append another chunk to the buffer, returning False at the end of the document"""
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        n = max(self.chunk_size, at_least)
+        if self.max_size is not None:
+            n = min(n, self.max_size - self.size + 1)
+        chunk = self.read(n)
+        if not chunk:
+            self.eof = True
+            return False
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ResponseTooLarge('response is larger than ' + str(self.max_size) + ' bytes')
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, or '' at the end of the document"""
+        while 1:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected ' + char + ' at byte ' + str(self.size - len(self.buf) + self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decode the whole value at the current position"""
+        self.peek()
+        while 1:
             try:
-                x = int(x)
-                elem = elem[x]
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer, or cut off after e.g. '1.' or '1e', may go on in the next chunk
+                cut = isinstance(value, (int, long, float)) and not isinstance(value, bool) \
+                    and (end == len(self.buf) or self.buf[end] in '.eE+-0123456789')
+                if not cut or self.eof:
+                    self.pos = end
+                    return value
             except ValueError:
-                elem = elem.get(x)
-    except:
-        pass
+                if self.eof:
+                    raise
+            # read at least as much again, so a large value is decoded O(log n) times
+            self.more(len(self.buf) - self.pos)
+
+class JsonExtractor(object):
+    """Pulls the values at a set of xpaths (see XPath) out of a JSON document as it is read
+
+    Only objects and arrays along the requested paths are walked, everything
+    else is skipped by the C decoder. Once every path has been found reading
+    stops, unless a path has a wildcard or filter and so may match anywhere in
+    the document. A large document is never held or decoded as a whole.
+    """
+
+    def __init__(self, paths):
+        self.xpaths = [ compile_xpath(path) for path in sorted(set(paths)) ]
+        self.stop_early = not any([ xpath.multi for xpath in self.xpaths ])
+        # tree of path steps, the None key of a node lists the xpaths that end there
+        self.tree = {}
+        for xpath in self.xpaths:
+            node = self.tree
+            for step in xpath.steps:
+                node = node.setdefault(step, {})
+            node.setdefault(None, []).append(xpath)
+
+    def extract(self, read, max_size=None, chunk_size=16384):
+        """Return {path: value} for the paths found in the document read with read(n)
+
+        Like XPath.get, paths with a wildcard or filter map to a list of every
+        match and other paths that aren't found are left out. Raises ValueError
+        for malformed JSON and ResponseTooLarge after max_size bytes.
+        """
+        found = {}
+        try:
+            self._walk(JsonStream(read, chunk_size, max_size), [self.tree], found)
+        except _AllFound:
+            pass
+        for xpath in self.xpaths:
+            if xpath.multi:
+                found.setdefault(xpath.path, [])
+        return found
+
+    def _children(self, nodes, key=None, index=None):
+        children = []
+        for node in nodes:
+            for step, child in node.items():
+                if step is None:
+                    continue
+                if step[0] == '*' or (step[0] == 'key' and ((key is not None and step[1] == key) or (index is not None and step[2] == index))):
+                    children.append(child)
+        return children
+
+    def _walk(self, stream, nodes, found):
+        # paths ending here, filtering here or counting from the end of an array need the whole value
+        for node in nodes:
+            if None in node or any([ step[0] == 'filter' or (step[0] == 'key' and step[2] is not None and step[2] < 0) for step in node if step is not None ]):
+                self._resolve(stream.value(), nodes, found)
+                return
+        c = stream.peek()
+        if c == '{':
+            stream.pos += 1
+            if stream.peek() == '}':
+                stream.pos += 1
+                return
+            while 1:
+                key = stream.value()
+                stream.expect(':')
+                children = self._children(nodes, key=key)
+                if children:
+                    self._walk(stream, children, found)
+                else:
+                    stream.value()
+                c = stream.peek()
+                stream.pos += 1
+                if c == '}':
+                    return
+                if c != ',':
+                    raise ValueError('malformed JSON object')
+        elif c == '[':
+            stream.pos += 1
+            if stream.peek() == ']':
+                stream.pos += 1
+                return
+            i = 0
+            while 1:
+                children = self._children(nodes, index=i)
+                if children:
+                    self._walk(stream, children, found)
+                else:
+                    stream.value()
+                c = stream.peek()
+                stream.pos += 1
+                if c == ']':
+                    return
+                if c != ',':
+                    raise ValueError('malformed JSON array')
+                i += 1
+        else:
+            stream.value()
+
+    def _resolve(self, value, nodes, found):
+        """Record the paths ending at value, and those continuing inside it"""
+        for node in nodes:
+            for step, child in node.items():
+                if step is None:
+                    for xpath in child:
+                        if xpath.multi:
+                            found.setdefault(xpath.path, []).append(value)
+                        else:
+                            found[xpath.path] = value
+                else:
+                    for sub in _select(step, value):
+                        self._resolve(sub, [child], found)
+        if self.stop_early and len(found) == len(self.xpaths):
+            raise _AllFound()
+
+# dicts
+
+# returned by XPath.get when a path isn't in the document, None is a JSON null
+MISSING = object()
+
+_STEP = re.compile(r'^([^\[\]]*)(?:\[([^=\]]+)=([^\]]*)\])?$')
+_INDEX = re.compile(r'^-?\d+$')
 
-    return elem
+def json_value_matches(value, expected):
+    """True if a decoded JSON value equals an expected value written as a string (1, true, null)"""
+    if isinstance(value, basestring):
+        return value == expected
+    return value == expected or json.dumps(value) == expected
+
+def _select(step, value):
+    """Values a compiled step selects from value"""
+    kind = step[0]
+    if kind == 'key':
+        if isinstance(value, dict):
+            if step[1] in value:
+                return [value[step[1]]]
+        elif isinstance(value, list) and step[2] is not None and -len(value) <= step[2] < len(value):
+            return [value[step[2]]]
+        return []
+    items = value if isinstance(value, list) else (value.values() if isinstance(value, dict) else [])
+    if kind == '*':
+        return items
+    # filter
+    return [ item for item in items if isinstance(item, dict) and step[1] in item and json_value_matches(item[step[1]], step[2]) ]
+
+class XPath(object):
+    """A path into a decoded JSON document, compiled once, like a/0/b, items/*/status or items[status=ok]/id
+
+    Steps are separated by /. A step is an object key (or array index,
+    negative ones counting from the end), or *
+    for every member of an array or object, and may end with [key=value] to
+    keep only the members that have key equal to value. Paths with * or a
+    filter match any number of values.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        for part in path.strip('/').split('/'):
+            m = _STEP.match(part)
+            if m is None:
+                raise ValueError('invalid xpath step "' + part + '" in ' + path)
+            name, filter_key, filter_value = m.groups()
+            if name == '*':
+                self.steps.append(('*',))
+            else:
+                self.steps.append(('key', name, int(name) if _INDEX.match(name) else None))
+            if filter_key is not None:
+                self.steps.append(('filter', filter_key, filter_value))
+        self.multi = any([ step[0] != 'key' for step in self.steps ])
+
+    def find(self, doc):
+        """Every value at this path, in document order"""
+        values = [doc]
+        for step in self.steps:
+            selected = []
+            for value in values:
+                selected.extend(_select(step, value))
+            values = selected
+        return values
+
+    def get(self, doc):
+        """Value at this path or MISSING, or for paths with * or a filter the list of every match"""
+        if self.multi:
+            return self.find(doc)
+        value = doc
+        for step in self.steps:
+            if isinstance(value, dict):
+                if step[1] not in value:
+                    return MISSING
+                value = value[step[1]]
+            elif isinstance(value, list) and step[2] is not None and -len(value) <= step[2] < len(value):
+                value = value[step[2]]
+            else:
+                return MISSING
+        return value
+
+_XPATHS = {}
+
+def compile_xpath(path):
+    xpath = _XPATHS.get(path)
+    if xpath is None:
+        xpath = _XPATHS[path] = XPath(path)
+    return xpath
+
+def xpath_get(mydict, path):
+    """Value at path in mydict, None if it isn't there (see XPath for the path syntax)"""
+    value = compile_xpath(path).get(mydict)
+    return None if value is MISSING else value
 
 # time
 
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('linux'):
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+            clock_gettime = libc.clock_gettime
+        except (OSError, AttributeError):
+            return time.time
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+# seconds from a clock that never goes backwards, only meaningful for differences
+monotonic = _get_monotonic()
+
 def get_current_time():
     return datetime.datetime.utcnow()
 
 def get_current_time_numeric():
-    return self.get_current_time().strftime('%Y%m%d%H%M%S%f')
+    return get_current_time().strftime('%Y%m%d%H%M%S%f')
 
 # result in milliseconds
 def get_time_diff(t1, t2):
-    return int((t2 - t1).microseconds/1000)
+    return int((t2 - t1).total_seconds() * 1000)
 
+# stats
+
+class Histogram(object):
+    """Log-linear histogram of non-negative integers (e.g. latency in microseconds)
+
+    Values below 2 * 2**SUB_BITS are counted exactly, larger ones in buckets
+    whose width is 1/2**SUB_BITS of their power of two, so percentiles are
+    accurate to about 3%. Counts live in an array that only grows as far as
+    the largest value recorded.
+    """
+
+    SUB_BITS = 5
+    SUB_COUNT = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = array.array('L')
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < 2 * self.SUB_COUNT:
+            return value
+        shift = value.bit_length() - self.SUB_BITS - 1
+        return (shift + 1) * self.SUB_COUNT + (value >> shift) - self.SUB_COUNT
+
+    def _value(self, index):
+        """Midpoint of the bucket at index"""
+        if index < 2 * self.SUB_COUNT:
+            return index
+        shift = index // self.SUB_COUNT - 1
+        lower = (index % self.SUB_COUNT + self.SUB_COUNT) << shift
+        return lower + ((1 << shift) - 1) // 2
+
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        i = self._index(value)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is not None:
+                self.min = v if self.min is None else min(self.min, v)
+                self.max = v if self.max is None else max(self.max, v)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(max(self._value(i), self.min), self.max)
+        return self.max
+
+    def summary(self, scale=1, percentiles=(50, 90, 99)):
+        """min, percentiles and max (each divided by scale), or None if nothing was recorded"""
+        if self.count == 0:
+            return None
+        res = {'count': self.count, 'min': self.min / float(scale), 'max': self.max / float(scale), 'mean': self.total / float(self.count) / scale}
+        for p in percentiles:
+            res['p' + str(p)] = self.percentile(p) / float(scale)
+        return res
+
+# metrics
+
+class Metrics(object):
+    """Counters, gauges and latency summaries, exposed in the Prometheus text format
+
+    Every series is a metric name plus a tuple of label values. Recording
+    takes one lock and bumps a counter or a Histogram; gauges are callables
+    that are only evaluated when the metrics are rendered. Summaries are
+    cumulative since the process started.
+    """
+
+    QUANTILES = (50, 90, 99)
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()  # name -> (type, help, label names, func)
+        self._series = {}   # name -> {label values: count or Histogram of microseconds}
+
+    def _declare(self, name, kind, help, labels, func=None):
+        with self._lock:
+            self._metrics[name] = (kind, help, tuple(labels), func)
+            self._series.setdefault(name, {})
+
+    def counter(self, name, help, labels=()):
+        self._declare(name, 'counter', help, labels)
+
+    def summary(self, name, help, labels=()):
+        """A latency in seconds, reported as quantiles, a sum and a count"""
+        self._declare(name, 'summary', help, labels)
+
+    def gauge(self, name, help, func, kind='gauge'):
+        """A value read from func() at render time, kind may be counter for running totals kept elsewhere"""
+        self._declare(name, kind, help, (), func)
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, seconds, labels=()):
+        with self._lock:
+            series = self._series[name]
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = Histogram()
+            hist.record(seconds * 1000000)
+
+    def forget(self, label, value):
+        """Drop every series with label set to value, e.g. those of a removed container"""
+        with self._lock:
+            for name, (kind, help, labels, func) in self._metrics.items():
+                if label in labels:
+                    i = labels.index(label)
+                    series = self._series[name]
+                    for key in series.keys():
+                        if key[i] == value:
+                            del series[key]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = self._metrics.items()
+            snapshot = {}
+            for name, (kind, help, labels, func) in metrics:
+                if func is None:
+                    snapshot[name] = [ (key, series if kind == 'counter' else series.summary(scale=1000000.0, percentiles=self.QUANTILES)) for key, series in sorted(self._series[name].items()) ]
+        for name, (kind, help, labels, func) in metrics:
+            full_name = self.prefix + name
+            lines.append('# HELP ' + full_name + ' ' + help)
+            lines.append('# TYPE ' + full_name + ' ' + kind)
+            if func is not None:
+                try:
+                    lines.append(full_name + ' ' + repr(float(func())))
+                except Exception:
+                    traceback.print_exc()
+                continue
+            for key, value in snapshot[name]:
+                pairs = zip(labels, key)
+                if kind == 'counter':
+                    lines.append(full_name + _labels(pairs) + ' ' + repr(float(value)))
+                    continue
+                for q in self.QUANTILES:
+                    lines.append(full_name + _labels(pairs + [('quantile', str(q / 100.0))]) + ' ' + repr(value['p' + str(q)]))
+                lines.append(full_name + '_sum' + _labels(pairs) + ' ' + repr(value['mean'] * value['count']))
+                lines.append(full_name + '_count' + _labels(pairs) + ' ' + str(value['count']))
+        return '\n'.join(lines) + '\n'
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = [ k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in pairs ]
+    return '{' + ','.join(escaped) + '}'
+
+def serve_metrics(metrics, port, address='', routes=None):
+    """Serve metrics.render() at /metrics from a daemon thread, returning the server
+
+    routes maps other paths to functions taking the query parameters (a dict
+    of lists) and returning a JSON serializable answer.
+    """
+
+    routes = routes or {}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            if url.path == '/metrics':
+                body = metrics.render()
+                content_type = 'text/plain; version=0.0.4'
+            elif url.path in routes:
+                try:
+                    body = json.dumps(routes[url.path](urlparse.parse_qs(url.query)), indent=4)
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), Handler)
+    t = threading.Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    return server
+
+# history
+
+class _Segment(object):
+    """One memory-mapped segment file of a ResultStore: a header, then each column for capacity records"""
+
+    HEADER = struct.Struct('<4sIII')    # magic, capacity, record count, unused
+    MAGIC = 'RST1'
+    COLUMNS = (('timestamp', 'd'), ('series', 'I'), ('code', 'i'), ('duration', 'f'))
+
+    def __init__(self, path, start, seq, capacity=None, writable=False):
+        """Open the segment at path, creating it first for capacity records if given"""
+        self.path = path
+        self.start = start
+        self.seq = seq
+        if capacity is not None:
+            size = self.HEADER.size + capacity * sum([ struct.calcsize(fmt) for name, fmt in self.COLUMNS ])
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, capacity, 0, 0))
+                f.truncate(size)
+        self.file = open(path, 'r+b' if writable else 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, self.capacity, count, unused = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError('not a result store segment: ' + path)
+        self.offsets = {}
+        self.formats = {}
+        offset = self.HEADER.size
+        for name, fmt in self.COLUMNS:
+            self.offsets[name] = offset
+            self.formats[name] = struct.Struct('<' + fmt)
+            offset += self.capacity * self.formats[name].size
+
+    @property
+    def count(self):
+        return self.HEADER.unpack_from(self.mm, 0)[2]
+
+    def append(self, values):
+        i = self.count
+        for name, fmt in self.COLUMNS:
+            column = self.formats[name]
+            column.pack_into(self.mm, self.offsets[name] + i * column.size, values[name])
+        # the count is written last, so readers never see a partial record
+        struct.pack_into('<I', self.mm, 8, i + 1)
+
+    def column(self, name, count):
+        """The first count values of a column, as an array"""
+        fmt = dict(self.COLUMNS)[name]
+        values = array.array(fmt)
+        offset = self.offsets[name]
+        values.fromstring(self.mm[offset:offset + count * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+class ResultStore(object):
+    """Append-only history of task results, kept on disk in memory-mapped segments
+
+    A segment holds the results of segment_seconds of wall time, up to
+    capacity records of 20 bytes each, laid out column by column so a query
+    only reads the columns of the segments in its window. Results are
+    identified by series, a (container, task) pair numbered in a series file.
+    Segments older than retention seconds are deleted as new ones are started.
+    """
+
+    def __init__(self, path, segment_seconds=3600, retention=86400, capacity=65536):
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.capacity = capacity
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._keys = []     # series id -> (container, task)
+        self._series = {}   # (container, task) -> series id
+        series_path = os.path.join(path, 'series')
+        if os.path.exists(series_path):
+            with open(series_path) as f:
+                for line in f:
+                    self._add_series(tuple(json.loads(line)))
+        self._series_file = open(series_path, 'a')
+        self._segment = None
+
+    def _add_series(self, key):
+        self._series[key] = len(self._keys)
+        self._keys.append(key)
+        return self._series[key]
+
+    def _series_id(self, key):
+        # caller must hold self._lock
+        series = self._series.get(key)
+        if series is None:
+            series = self._add_series(key)
+            self._series_file.write(json.dumps(list(key)) + '\n')
+            self._series_file.flush()
+        return series
+
+    def _segments(self):
+        """(start, seq, path) of every segment file, oldest first"""
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith('.seg'):
+                start, seq = name[:-4].split('-')
+                segments.append((int(start), int(seq), os.path.join(self.path, name)))
+        return sorted(segments)
+
+    def _writable(self, now):
+        # caller must hold self._lock
+        start = int(now - now % self.segment_seconds)
+        segment = self._segment
+        if segment is not None and segment.start == start and segment.count < segment.capacity:
+            return segment
+        if segment is not None:
+            segment.close()
+        seq = 0
+        # carry on with the latest segment of this window, e.g. after a restart
+        existing = [ s for s in self._segments() if s[0] == start ]
+        if existing:
+            seq = existing[-1][1]
+            segment = _Segment(existing[-1][2], start, seq, writable=True)
+            if segment.count >= segment.capacity:
+                segment.close()
+                segment = None
+                seq += 1
+        else:
+            segment = None
+        if segment is None:
+            path = os.path.join(self.path, '%d-%d.seg' % (start, seq))
+            segment = _Segment(path, start, seq, capacity=self.capacity, writable=True)
+        self._segment = segment
+        self._expire(now)
+        return segment
+
+    def _expire(self, now):
+        for start, seq, path in self._segments():
+            if start + self.segment_seconds < now - self.retention:
+                os.remove(path)
+
+    def append(self, container, task, code, duration_ms, timestamp=None):
+        """Record one task result, duration_ms is -1 if the task didn't run"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            segment = self._writable(timestamp)
+            segment.append({'timestamp': timestamp, 'series': self._series_id((container, task)), 'code': code, 'duration': duration_ms})
+
+    def aggregate(self, since, until=None, container=None, task=None):
+        """Per (container, task) aggregates of the results recorded from since until until
+
+        Returns a list of dicts with the container and task, the number of
+        results, a count per result code, the first and last timestamp and a
+        summary of the durations in milliseconds. Segments are read one at a
+        time and only within the window.
+        """
+        until = time.time() if until is None else until
+        with self._lock:
+            wanted = set([ i for i, key in enumerate(self._keys) if container in (None, key[0]) and task in (None, key[1]) ])
+            keys = list(self._keys)
+        aggregates = {}
+        for start, seq, path in self._segments():
+            if start >= until or start + self.segment_seconds < since:
+                continue
+            try:
+                segment = _Segment(path, start, seq)
+            except (IOError, OSError, ValueError):
+                # expired or half created meanwhile
+                continue
+            try:
+                count = segment.count
+                timestamps = segment.column('timestamp', count)
+                series = segment.column('series', count)
+                codes = segment.column('code', count)
+                durations = segment.column('duration', count)
+            finally:
+                segment.close()
+            for i in xrange(count):
+                if series[i] not in wanted or not since <= timestamps[i] < until:
+                    continue
+                agg = aggregates.get(series[i])
+                if agg is None:
+                    agg = aggregates[series[i]] = {'count': 0, 'codes': {}, 'first': timestamps[i], 'last': timestamps[i], 'durations': Histogram()}
+                agg['count'] += 1
+                agg['codes'][codes[i]] = agg['codes'].get(codes[i], 0) + 1
+                agg['first'] = min(agg['first'], timestamps[i])
+                agg['last'] = max(agg['last'], timestamps[i])
+                if durations[i] >= 0:
+                    agg['durations'].record(durations[i] * 1000)
+        res = []
+        for series_id, agg in sorted(aggregates.items()):
+            durations = agg.pop('durations')
+            agg['container'], agg['task'] = keys[series_id]
+            agg['duration-ms'] = durations.summary(scale=1000)
+            res.append(agg)
+        return res
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._series_file.close()
 
 # string
 
+_RAND_COUNTER = itertools.count()
+
 def get_rand_string(base_name='user'):
-    return base_name + Time.get_current_time_numeric()
+    # the counter keeps strings made in the same microsecond, e.g. by concurrent instances, apart
+    return base_name + get_current_time_numeric() + '%03d' % (next(_RAND_COUNTER) % 1000)
 
 def load_json_template(path, key_vals):
 
@@ -11,6 +11,14 @@ import re
 import socket
 import threading
 import traceback
+import time
+import hashlib
+import collections
+import math
+import datetime
+import multiprocessing
+import Queue
+import signal
 
 # config
 DEBUG = True
@@ -18,6 +26,38 @@ CFG_FILE = 'config.json'
 ROUTINES = 'routines_tmp/'
 DEFAULT_PORT = 8080
 CHECK_NAME = 'monitor'
+SCHEDULER_LAG_WARNING = 5 # seconds
+EVENTS_RETRY_SECONDS = 5
+ROUTINE_FETCH_TIMEOUT = 30 # seconds
+RESULT_RETRY_MIN = 1 # seconds
+RESULT_RETRY_MAX = 60
+METRICS_PORT = 9102
+DOCKER_URL = 'unix://var/run/docker.sock'
+WORKER_STATS_FREQ = 10 # seconds
+WORKER_CHECK_FREQ = 5
+CONFIG_CHECK_FREQ = 5 # seconds between checks of the config file for changes
+# config that is only read at startup
+RESTART_KEYS = ['scheduler', 'result-sender', 'worker-processes', 'metrics', 'docker-events', 'routine-cache', 'result-store']
+HISTORY_WINDOW = 60 # minutes queried from the result store unless asked otherwise
+DETAIL_LIMIT = 512 # chars of each failed task's result-detail posted to the server
+
+# internal metrics, served at /metrics when enabled in the config
+METRICS = ss_utils.Metrics(prefix='monitor_agent_')
+METRICS.summary('routine_duration_seconds', 'Time to run the routine of a container', ('container',))
+METRICS.summary('task_duration_seconds', 'Time to run a task, all instances included', ('container', 'task', 'type'))
+METRICS.counter('checks_total', 'Check results by status (0 ok, 1 warning, 2 critical)', ('status',))
+METRICS.counter('checks_skipped_total', 'Checks not run because the container kept failing, its last result was reported instead')
+METRICS.summary('docker_duration_seconds', 'Time spent in docker cp of routine files and in each docker exec of execute tasks', ('op',))
+METRICS.summary('server_request_duration_seconds', 'Latency of requests to the server', ('method', 'path'))
+METRICS.counter('server_request_errors_total', 'Requests to the server that failed or returned a 5xx status', ('method', 'path'))
+METRICS.summary('update_duration_seconds', 'Time to reconcile containers with the clients on the server')
+
+# on-disk history of task results, set up at startup if the result store is enabled
+HISTORY = None
+# decides which results get posted when only changes are reported, None posts them all
+REPORTER = None
+# whether the events watcher was started, fixed until a restart like docker-events itself
+EVENTS_ENABLED = False
 
 
 # helpers
@@ -52,10 +92,8 @@ def get_host(container_obj):
 
     return routine_runner.HostSet(cfg)
 
-def get_routine(tasks_file):
-    with open(tasks_file) as f:
-        tasks = json.load(f)
-        f.close()
+def get_routine(content):
+    tasks = json.loads(content)
     cfg = {
         'name': 'monitor',
         'tasks': tasks
@@ -63,15 +101,178 @@ def get_routine(tasks_file):
 
     return routine_runner.Routine(cfg)
 
+def fetch_routine_file(container_obj):
+    """Copy the routine file out of a container and return its contents, or None if it has none"""
+
+    name = get_container_name(container_obj)
+    container_routine_file = CFG['routine-file']
+    routine_file = ROUTINES + name + '.json'
+    debug('copying ' + container_routine_file + ' from container ' + name + ' to ' + routine_file)
+    cmd = 'docker cp ' + name + ':' + container_routine_file + ' ' + routine_file
+    debug('running cmd: ' + cmd)
+    start = ss_utils.monotonic()
+    try:
+        cp = ss_utils.run_cmd(cmd.strip(), timeout=ROUTINE_FETCH_TIMEOUT)
+    except ss_utils.CommandTimeout:
+        log('timed out copying ' + container_routine_file + ' from container ' + name)
+        return None
+    finally:
+        METRICS.observe('docker_duration_seconds', ss_utils.monotonic() - start, ('cp',))
+    if cp[0] != 0:
+        return None
+    with open(routine_file) as f:
+        return f.read()
+
+class RoutineCache(object):
+    """Parsed routines per container, shared by containers that ship identical routine files
+
+    A container's routine file is only fetched again once its entry has been
+    invalidated (container started, stopped or removed) or is older than
+    revalidate_freq seconds. Parsed routines are kept by content hash, up to
+    max_routines of them, least recently used evicted first.
+    """
+
+    def __init__(self, fetch, revalidate_freq=300, max_routines=100):
+        self.fetch = fetch
+        self.revalidate_freq = revalidate_freq
+        self.max_routines = max_routines
+        self._lock = threading.Lock()
+        self._containers = {}   # container id -> (content hash or None if no file, time fetched)
+        self._routines = collections.OrderedDict()  # content hash -> Routine
+
+    def get(self, container_obj):
+        """Routine for a container, or None if the container has no routine file"""
+        container_id = container_obj['Id']
+        with self._lock:
+            entry = self._containers.get(container_id)
+            if entry is not None and time.time() - entry[1] < self.revalidate_freq:
+                if entry[0] is None:
+                    return None
+                if entry[0] in self._routines:
+                    routine = self._routines.pop(entry[0])
+                    self._routines[entry[0]] = routine
+                    return routine
+
+        content = self.fetch(container_obj)
+        if content is None:
+            # remember that there is no routine file until the next revalidation
+            with self._lock:
+                self._containers[container_id] = (None, time.time())
+            return None
+        digest = hashlib.sha1(content).hexdigest()
+        with self._lock:
+            routine = self._routines.pop(digest, None)
+        if routine is None:
+            debug('parsing new routine ' + digest + ' from ' + get_container_name(container_obj))
+            routine = get_routine(content)
+
+        with self._lock:
+            self._routines[digest] = routine
+            while len(self._routines) > self.max_routines:
+                self._routines.popitem(last=False)
+            self._containers[container_id] = (digest, time.time())
+        return routine
+
+    def invalidate(self, container_id):
+        with self._lock:
+            self._containers.pop(container_id, None)
+
+    def clear(self):
+        """Fetch every routine file again, e.g. after the routine-file path changed"""
+        with self._lock:
+            self._containers.clear()
+
+    def retain(self, container_ids):
+        """Forget every container not in container_ids"""
+        container_ids = set(container_ids)
+        with self._lock:
+            for container_id in self._containers.keys():
+                if container_id not in container_ids:
+                    del self._containers[container_id]
+
+    def stats(self):
+        with self._lock:
+            return {'containers': len(self._containers), 'routines': len(self._routines)}
+
 def run_routine(routine, host):
-    return routine_runner.Runner(routine, host).run()
+    # execute tasks go through the docker API unless configured to use the CLI
+    docker_client = CLI if CFG.get('exec-backend', 'api') == 'api' else None
+    start = ss_utils.monotonic()
+    res = routine_runner.Runner(routine, host, docker_client=docker_client).run()
+    METRICS.observe('routine_duration_seconds', ss_utils.monotonic() - start, (host.name,))
+    for task in res['task-results']:
+        if task['task-duration-ms'] == 'N/A':
+            continue
+        seconds = task['task-duration-ms'] / 1000.0
+        METRICS.observe('task_duration_seconds', seconds, (host.name, task['name'], task['type']))
+    return res
+
+class FrequencyRules(object):
+    """The frequencies config, compiled once, deciding how often each container is checked
+
+    A rule has seconds and any of pattern (regex on the container name), image
+    (regex on its image) and labels ({label: regex on its value}), all of which
+    must match; the first matching rule wins. Results are memoized per
+    container name, or per name, image and labels when a rule needs them, and
+    go away with this object when the config is reloaded.
+    """
 
-def get_check_freq(container_name):
+    MAX_MEMO = 10000
 
-    for freq in CFG['frequencies']:
-        if re.match('^'+freq['pattern']+'$', container_name):
-            return freq['seconds']
-    return None
+    def __init__(self, rules):
+        self.rules = []
+        for rule in rules:
+            pattern = re.compile('^(?:' + rule['pattern'] + ')$') if 'pattern' in rule else None
+            image = re.compile('^(?:' + rule['image'] + ')$') if 'image' in rule else None
+            labels = [ (label, re.compile('^(?:' + value + ')$')) for label, value in sorted(rule.get('labels', {}).items()) ]
+            self.rules.append((pattern, image, labels, rule['seconds']))
+        self.uses_attributes = any([ image is not None or labels for pattern, image, labels, seconds in self.rules ])
+        self._memo = {}
+
+    def get(self, container_obj):
+        """Seconds between checks of a container, None if it shouldn't be checked"""
+        name = get_container_name(container_obj)
+        image = container_obj.get('Image') or ''
+        labels = container_obj.get('Labels') or {}
+        key = (name, image, tuple(sorted(labels.items()))) if self.uses_attributes else name
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        res = None
+        for pattern, image_re, label_res, seconds in self.rules:
+            if pattern is not None and not pattern.match(name):
+                continue
+            if image_re is not None and not image_re.match(image):
+                continue
+            if not all([ label in labels and value_re.match(labels[label]) for label, value_re in label_res ]):
+                continue
+            res = seconds
+            break
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[key] = res
+        return res
+
+def get_check_freq(container_obj):
+
+    return FREQUENCIES.get(container_obj)
+
+def server_request(method, uri, data=None):
+    """server_conn.request, timed for the metrics"""
+
+    labels = (method, '/' + uri.split('/')[1])
+    start = ss_utils.monotonic()
+    try:
+        resp = server_conn.request(method, uri, data=data)
+    except:
+        METRICS.inc('server_request_errors_total', labels)
+        raise
+    finally:
+        METRICS.observe('server_request_duration_seconds', ss_utils.monotonic() - start, labels)
+    if resp.status > 499:
+        METRICS.inc('server_request_errors_total', labels)
+    return resp
 
 # actions
 
@@ -79,44 +280,39 @@ def update():
 
     debug('updating server with current container list state')
 
+    start = ss_utils.monotonic()
     try:
-        # get updated list of containers running on this host
-        containers = CLI.containers()
-        container_names = [ get_container_name(c) for c in containers ]
-
-        # get updated list of clients configured on the server that were created from this host
-        all_clients = json.loads(server_conn.request('GET', '/clients').read())
-        clients = [ client for client in all_clients if client['address'] == HOSTNAME ]
-        client_names = [ client['name'] for client in clients ]
-
-        for container in containers:
-            name = get_container_name(container)
-            #debug('getting configured check freq for: ' + name)
-            freq = get_check_freq(name)
-            if not freq:
-                debug('frequency for container ' + name + ' is null, skipping')
-                continue
-            # add clients that don't exist on the server
-            if name not in client_names:
-                log('new container found: ' + name)
-                log('posting client ' + name + ' to server')
-                add_client(name)
-            # add check timers that don't exist
-            if name not in CHECK_TIMERS:
-                log('creating check timer for ' + name + ' with freq: ' + str(freq))
-                create_check_timer(container, freq)
-                
-
-        # delete clients that don't exist locally
-        for client in clients:
-            if client['address'] == HOSTNAME:
-                client_name = client['name']
-                if client_name not in container_names:
-                    log('container for client ' + client_name + ' no longer exists')
-                    log('deleting client')
-                    delete_client(client_name)
-                    log('canceling check timer for container: ' + client_name)
-                    CHECK_TIMERS.pop(client_name).shutdown()
+        with CONTAINERS_LOCK:
+            # get updated list of containers running on this host
+            containers = CLI.containers()
+            container_names = [ get_container_name(c) for c in containers ]
+
+            # get updated list of clients configured on the server that were created from this host
+            all_clients = json.loads(server_request('GET', '/clients').read())
+            clients = [ client for client in all_clients if client['address'] == HOSTNAME ]
+            client_names = [ client['name'] for client in clients ]
+
+            CONTAINER_IDS.clear()
+            for container in containers:
+                add_container(container, client_names)
+            ROUTINE_CACHE.retain([ c['Id'] for c in containers ])
+
+            # delete clients that don't exist locally
+            for client in clients:
+                if client['address'] == HOSTNAME:
+                    client_name = client['name']
+                    if client_name not in container_names:
+                        log('container for client ' + client_name + ' no longer exists')
+                        remove_container(client_name)
+
+        stats = SCHEDULER.stats()
+        if stats['max-lag'] > SCHEDULER_LAG_WARNING:
+            log('checks are running behind schedule: ' + json.dumps(stats))
+        else:
+            debug('scheduler: ' + json.dumps(stats))
+        debug('routine cache: ' + json.dumps(ROUTINE_CACHE.stats()))
+        debug('circuits: ' + json.dumps(BREAKER.stats()))
+        debug('result queue: ' + json.dumps(RESULTS.stats()))
 
         # unpause all check timers in case any were paused
         #for name,timer in CHECK_TIMERS.items():
@@ -129,10 +325,110 @@ def update():
         # pause all check timers
         #for name,timer in CHECK_TIMERS.items():
         #    timer.paused = True
+    finally:
+        METRICS.observe('update_duration_seconds', ss_utils.monotonic() - start)
+
+def add_container(container, client_names=None):
+    """Make sure a running container has a client on the server and a scheduled check
+
+    client_names is the list of clients already on the server, if known, so
+    existing ones aren't posted again.
+    """
+    name = get_container_name(container)
+    freq = get_check_freq(container)
+    if not freq:
+        debug('frequency for container ' + name + ' is null, skipping')
+        # a reload may have turned off checks of a container that had a client and a check
+        if name in SCHEDULER:
+            remove_container(name)
+        return
+    CONTAINER_IDS[container['Id']] = name
+    # add clients that don't exist on the server
+    if client_names is None or name not in client_names:
+        log('new container found: ' + name)
+        log('posting client ' + name + ' to server')
+        add_client(name)
+    # schedule checks that don't exist, pick up frequency changes for those that do
+    if name not in SCHEDULER:
+        log('scheduling check for ' + name + ' with freq: ' + str(freq))
+        schedule_check(container, freq)
+    elif SCHEDULER.get_interval(name) != freq:
+        log('changing check freq for ' + name + ' to: ' + str(freq))
+        SCHEDULER.reschedule(name, freq)
+
+def remove_container(name):
+
+    log('deleting client ' + name)
+    delete_client(name)
+    log('canceling check for container: ' + name)
+    SCHEDULER.cancel(name)
+    BREAKER.forget(name)
+    if REPORTER is not None:
+        REPORTER.forget(name)
+    METRICS.forget('container', name)
+
+def handle_event(event):
+    """Apply a single container event from the docker events API"""
+
+    # newer daemons describe the container under Actor, older ones only send status and id
+    action = event.get('Action', event.get('status'))
+    container_id = event.get('id') or event.get('Actor', {}).get('ID')
+    attributes = event.get('Actor', {}).get('Attributes', {})
+    if event.get('Type', 'container') != 'container' or action not in ('start', 'die', 'destroy', 'rename'):
+        return
+    if not container_id:
+        debug('docker event without a container id: ' + json.dumps(event))
+        return
+
+    debug('docker event: ' + action + ' ' + container_id)
+    # a (re)started container may ship a different routine file
+    ROUTINE_CACHE.invalidate(container_id)
+    with CONTAINERS_LOCK:
+        if action == 'die':
+            # only the check stops, the client is kept for a restart and left to destroy or update()
+            name = CONTAINER_IDS.get(container_id)
+            if name is not None and SCHEDULER.cancel(name):
+                log('container ' + name + ' stopped, canceled its check')
+            return
+        name = CONTAINER_IDS.pop(container_id, None)
+        known = name is not None
+        if action == 'rename' and name is None and attributes.get('oldName'):
+            name = attributes['oldName'].lstrip('/')
+        if name is not None and action in ('destroy', 'rename') and (known or name in SCHEDULER):
+            log('container ' + name + ' ' + ('renamed' if action == 'rename' else 'removed'))
+            remove_container(name)
+        if action in ('start', 'rename'):
+            for container in CLI.containers(filters={'id': container_id}):
+                # a container started again still has the client it had before it died
+                add_container(container, [name] if action == 'start' and known else None)
+
+def handle_events(events):
+    """Apply every event from an iterable of decoded docker events until it is exhausted"""
+
+    for event in events:
+        try:
+            handle_event(event)
+        except:
+            traceback.print_exc()
+            log('error in handling docker event: ' + json.dumps(event))
+
+def watch_events():
+    """Follow the docker events stream, reconnecting and reconciling whenever it drops"""
+
+    while 1:
+        try:
+            log('subscribing to docker container events')
+            handle_events(CLI.events(filters={'type': 'container'}, decode=True))
+        except:
+            traceback.print_exc()
+        log('docker event stream closed, reconnecting in ' + str(EVENTS_RETRY_SECONDS) + ' seconds')
+        time.sleep(EVENTS_RETRY_SECONDS)
+        # pick up anything that changed while disconnected
+        update()
 
 def delete_client(name):
 
-    resp = server_conn.request('DELETE', '/clients/' + name)
+    resp = server_request('DELETE', '/clients/' + name)
     debug('response: ' + str(resp.status))
 
 def add_client(name):
@@ -144,34 +440,176 @@ def add_client(name):
         'environment': ENV
         }
 
-    resp = server_conn.request('POST', '/clients', data=json.dumps(data))
+    resp = server_request('POST', '/clients', data=json.dumps(data))
     debug('response: ' + str(resp.status))
 
-def send_check_result(container_obj, routine_result, warn=None):
+class ResultReporter(object):
+    """Decides which check results get posted when only changes are reported
+
+    The outcome of a check is its status and the result of each task, not
+    their details. A result is posted in full when the outcome of a container
+    differs from its last one, or heartbeat seconds after its last full
+    result. In between, a compact keepalive is posted every keepalive seconds
+    and nothing otherwise.
+    """
+
+    def __init__(self, heartbeat=300, keepalive=60):
+        self.heartbeat = heartbeat
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._last = {}     # container name -> [outcome, time of last full result, time of last post]
+
+    def decide(self, name, outcome):
+        """'full', 'keepalive' or None for a check result with outcome"""
+        now = time.time()
+        with self._lock:
+            last = self._last.get(name)
+            if last is None or last[0] != outcome or now - last[1] >= self.heartbeat:
+                self._last[name] = [outcome, now, now]
+                return 'full'
+            if now - last[2] >= self.keepalive:
+                last[2] = now
+                return 'keepalive'
+            return None
+
+    def since(self, name):
+        """Time of the last full result of a container"""
+        with self._lock:
+            return self._last[name][1]
+
+    def forget(self, name):
+        with self._lock:
+            self._last.pop(name, None)
+
+def get_outcome(routine_result, warn=None):
+    """(status, outcome) of a check, outcome is the same for checks whose tasks had the same results"""
 
     if warn:
-        output = warn
+        return 1, (1, warn)
+    status = 0
+    if routine_result['tasks-failed'] != 0:
+        status = 2
+    elif routine_result.get('tasks-warned', 0) != 0:
         status = 1
-    else:
-        output = 'OK'
-        status = 0
-        if routine_result['tasks-failed'] != 0:
-            output = json.dumps([ res for res in routine_result['task-results'] if res['result'] not in ('SUCCESS', 'SKIPPED')])
-            status = 2
+    return status, (status,) + tuple([ (res['name'], res['result']) for res in routine_result['task-results'] ])
+
+def truncate(string, limit):
+    if len(string) <= limit:
+        return string
+    return string[:limit] + '... [' + str(len(string) - limit) + ' chars truncated]'
+
+class Keepalive(dict):
+    """Body of a keepalive result, posted like any other but never in place of a full result"""
+
+def send_check_result(container_obj, routine_result, warn=None, note=None):
+    """Queue the result of a check for the server, note is put in front of its output"""
 
     name = get_container_name(container_obj)
-    body = {
+    status, outcome = get_outcome(routine_result, warn)
+    METRICS.inc('checks_total', (str(status),))
+
+    report = 'full' if REPORTER is None else REPORTER.decide(name, outcome)
+    if report is None:
+        debug('result for ' + name + ' unchanged, not posting')
+        return
+    body_class = dict
+    if report == 'keepalive':
+        body_class = Keepalive
+        output = 'OK' if status == 0 else 'unchanged since ' + datetime.datetime.fromtimestamp(REPORTER.since(name)).strftime('%Y-%m-%d %H:%M:%S')
+    elif warn:
+        output = warn
+    elif status == 0:
+        output = 'OK'
+    else:
+        # details, e.g. whole response bodies, are cut down to a budget
+        limit = CFG.get('result-reporting', {}).get('detail-limit', DETAIL_LIMIT)
+        failed = [ res for res in routine_result['task-results'] if res['result'] not in ('SUCCESS', 'SKIPPED') ]
+        output = json.dumps([ dict(res, **{'result-detail': truncate(str(res['result-detail']), limit)}) for res in failed ])
+    if note:
+        output = note + output
+
+    body = body_class({
         'source': name,
         'name': CHECK_NAME,
         'output': output,
         'status': status
-        }
+        })
+
+    debug('queueing ' + json.dumps(body))
+    # a keepalive never takes the place of a full result that is still waiting to be posted
+    RESULTS.put(name, body, replace=(report != 'keepalive'))
+
+def result_dropped(name):
+    """A queued result of a container was dropped, so post its next one in full"""
+
+    if isinstance(SCHEDULER, WorkerPool):
+        SCHEDULER.forget_outcome(name)
+    elif REPORTER is not None:
+        REPORTER.forget(name)
+
+def record_history(name, routine_result):
+    """Keep the result of every task of a routine in the result store, if there is one"""
+
+    if HISTORY is None:
+        return
+    now = time.time()
+    for task in routine_result['task-results']:
+        code = getattr(routine_runner.TaskResult, task['result'])['code']
+        duration = -1 if task['task-duration-ms'] == 'N/A' else task['task-duration-ms']
+        HISTORY.append(name, task['name'], code, duration, now)
+
+def query_history(params):
+    """Task aggregates from the result store for the /history endpoint
+
+    Takes minutes (default HISTORY_WINDOW) and optionally container and task.
+    """
+    minutes = float(params.get('minutes', [HISTORY_WINDOW])[0])
+    container = params.get('container', [None])[0]
+    task = params.get('task', [None])[0]
+    return HISTORY.aggregate(time.time() - minutes * 60, container=container, task=task)
+
+def is_down(routine_result):
+    """True if not a single task of a routine got through, e.g. the container isn't answering"""
+    return routine_result['tasks-failed'] > 0 and routine_result['tasks-passed'] == 0 and routine_result.get('tasks-warned', 0) == 0
 
-    debug('sending ' + json.dumps(body))
-    resp = server_conn.request('POST', '/results', data=json.dumps(body))
+def send_circuit_open(container_obj, wait):
+    """Report the last failure again for a container whose checks are backed off"""
+
+    name = get_container_name(container_obj)
+    failures, routine_result = BREAKER.last_failure(name)
+    METRICS.inc('checks_skipped_total')
+    note = 'not checked, ' + str(failures) + ' checks failed in a row, next check in ' + str(int(math.ceil(wait))) + ' seconds, last output: '
+    send_check_result(container_obj, routine_result, note=note)
+
+def post_result(body):
+    """POST a check result to the server, returning False if it should be retried"""
+
+    try:
+        resp = server_request('POST', '/results', data=json.dumps(body))
+    except:
+        traceback.print_exc()
+        return False
     debug('response: ' + str(resp.status))
     if resp.status > 299:
-        log('error returned when trying to post check result for ' + name + ':' + resp.read())
+        log('error returned when trying to post check result for ' + body['source'] + ':' + resp.read())
+    # client errors won't get better by sending the same result again
+    return resp.status < 500
+
+def send_results():
+    """Deliver queued check results, backing off while the server is failing"""
+
+    delay = 0
+    while 1:
+        name, body = RESULTS.get()
+        if post_result(body):
+            delay = 0
+            continue
+        # retry later, unless a newer full result for the container has been queued meanwhile;
+        # a full queue drops the retry rather than a fresh result of another container
+        RESULTS.put(name, body, replace=lambda queued: isinstance(queued, Keepalive), evict=False)
+        delay = min(max(delay * 2, RESULT_RETRY_MIN), RESULT_RETRY_MAX)
+        log('unable to post check result for ' + name + ', retrying in ' + str(delay) + ' seconds')
+        time.sleep(delay)
 
 def run_check_fake(container_obj):
 
@@ -181,53 +619,454 @@ def run_check(container_obj):
 
     try:
         name = get_container_name(container_obj)
-        container_routine_file = CFG['routine-file']
-        routine_file = ROUTINES + name + '.json'
-        debug('copying ' + container_routine_file + ' from container ' + name + ' to ' + routine_file)
-        cmd = 'docker cp ' + name + ':' + container_routine_file + ' ' + routine_file
-        debug('running cmd: ' + cmd)
-        cp = ss_utils.run_cmd(cmd.strip())
-        if cp[0] != 0:
+        allowed, wait = BREAKER.allow(name)
+        if not allowed:
+            send_circuit_open(container_obj, wait)
+            return 1
+        routine = ROUTINE_CACHE.get(container_obj)
+        if routine is None:
+            container_routine_file = CFG['routine-file']
             log('unable to find ' + container_routine_file + ' for ' + name)
             send_check_result(container_obj, None, warn='unable to find ' + container_routine_file)
             return 1
 
         host = get_host(container_obj)
-        routine = get_routine(routine_file)
-    
+
         res = run_routine(routine, host)
 
         send_check_result(container_obj, res)
+        record_history(name, res)
+        if is_down(res):
+            # back off from the check interval, doubling with every failure once the circuit opens
+            interval = SCHEDULER.get_interval(name) if name in SCHEDULER else 1
+            delay = BREAKER.failure(name, res, base=interval)
+            if delay:
+                log('every task failing for ' + name + ', next check in ' + str(delay) + ' seconds')
+        else:
+            BREAKER.success(name)
     except:
         traceback.print_exc()
         return 1
     
-def create_check_timer(container_obj, freq):
+def schedule_check(container_obj, freq):
 
     name = get_container_name(container_obj)
-    t = ss_utils.TaskTimer(freq, run_check, container_obj)
-    CHECK_TIMERS[name] = t
+    SCHEDULER.schedule(name, freq, run_check, container_obj)
+
+# supervisor mode
+
+class ResultPipe(object):
+    """Stands in for RESULTS in a worker process, handing check results to the supervisor"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def put(self, key, item, replace=True):
+        self.events.put(('result', key, item, replace))
+
+class HistoryPipe(object):
+    """Stands in for HISTORY in a worker process, handing task results to the supervisor's store"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def append(self, *record):
+        self.events.put(('history', record))
+
+class WorkerPool(object):
+    """Runs checks in worker processes instead of a local Scheduler, with the same interface
+
+    Containers are assigned to workers by consistent hashing on their name.
+    Each worker schedules and runs the checks of its containers and sends the
+    results back, where they are queued in RESULTS and posted from this
+    process, which owns the server connection. If a worker dies its
+    containers move to the others until it has been restarted.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.ring = ss_utils.HashRing()
+        self._lock = threading.RLock()
+        self._assigned = {}     # container name -> [container obj, freq, worker index]
+        self._workers = {}      # worker index -> (process, command queue)
+        self._stats = {}        # worker index -> latest Scheduler stats
+        self._retired_overruns = 0  # overruns counted by workers that have since died
+        self._events = multiprocessing.Queue()
+
+    def _spawn(self, index):
+        commands = multiprocessing.Queue()
+        process = multiprocessing.Process(target=worker_main, args=(index, commands, self._events), name='worker-' + str(index))
+        process.daemon = True
+        process.start()
+        self._workers[index] = (process, commands)
+        self.ring.add(index)
+
+    def start(self):
+        # workers are forked before any other thread is started
+        for i in range(self.processes):
+            self._spawn(i)
+        t = threading.Thread(target=self.collect, name='collector')
+        t.daemon = True
+        t.start()
+
+    def _send(self, index, *command):
+        # a worker being restarted gets its checks back from rebalance()
+        worker = self._workers.get(index)
+        if worker is not None:
+            worker[1].put(command)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._assigned
+
+    def get_interval(self, key):
+        with self._lock:
+            return self._assigned[key][1]
+
+    def schedule(self, key, interval, task, container_obj):
+        # task is always run_check, workers run it with their own state
+        with self._lock:
+            index = self.ring.get(key)
+            old = self._assigned.get(key)
+            if old is not None and old[2] != index:
+                self._send(old[2], 'cancel', key)
+            self._assigned[key] = [container_obj, interval, index]
+            self._send(index, 'schedule', key, container_obj, interval)
+
+    def reschedule(self, key, interval):
+        with self._lock:
+            entry = self._assigned[key]
+            entry[1] = interval
+            self._send(entry[2], 'reschedule', key, interval)
+
+    def cancel(self, key):
+        with self._lock:
+            entry = self._assigned.pop(key, None)
+            if entry is None:
+                return False
+            self._send(entry[2], 'cancel', key)
+            return True
+
+    def forget_outcome(self, key):
+        """Have the worker of a container post its next result in full"""
+        with self._lock:
+            entry = self._assigned.get(key)
+            if entry is not None:
+                self._send(entry[2], 'forget', key)
+
+    def configure(self, cfg):
+        """Hand a reloaded config to every worker"""
+        with self._lock:
+            for index in self._workers.keys():
+                self._send(index, 'configure', cfg)
+
+    def rebalance(self):
+        """Move every container whose worker has changed on the ring"""
+        with self._lock:
+            moved = 0
+            for key, (container_obj, interval, index) in self._assigned.items():
+                if self.ring.get(key) != index:
+                    self.schedule(key, interval, None, container_obj)
+                    moved += 1
+            if moved:
+                log('moved ' + str(moved) + ' checks between workers')
+
+    def stats(self):
+        """Scheduler stats summed over the workers, as of their last report"""
+        with self._lock:
+            reports = self._stats.values()
+            res = {
+                'tasks': len(self._assigned),
+                'workers': sum([ r['workers'] for r in reports ]),
+                'processes': len(self._workers),
+                'pending': sum([ r['pending'] for r in reports ]),
+                'queued': sum([ r['queued'] for r in reports ]),
+                'overruns': self._retired_overruns + sum([ r['overruns'] for r in reports ]),
+                'max-lag': max([ r['max-lag'] for r in reports ] or [0]),
+                'avg-lag': round(sum([ r['avg-lag'] * r['tasks'] for r in reports ]) / max(sum([ r['tasks'] for r in reports ]), 1), 3)
+                }
+            return res
+
+    def check_workers(self):
+        """Restart dead workers, moving their checks to the others meanwhile"""
+        with self._lock:
+            for index, (process, commands) in self._workers.items():
+                if process.is_alive():
+                    continue
+                log('worker ' + str(index) + ' exited with ' + str(process.exitcode) + ', restarting')
+                self.ring.remove(index)
+                self._retired_overruns += self._stats.pop(index, {}).get('overruns', 0)
+                del self._workers[index]
+                self.rebalance()
+                self._spawn(index)
+                self.rebalance()
+
+    def collect(self):
+        """Queue the check results sent by workers and keep their stats, restarting any that die"""
+        last_check = time.time()
+        while 1:
+            try:
+                event = self._events.get(timeout=WORKER_CHECK_FREQ)
+                if event[0] == 'result':
+                    RESULTS.put(event[1], event[2], event[3])
+                elif event[0] == 'history':
+                    HISTORY.append(*event[1])
+                elif event[0] == 'stats':
+                    with self._lock:
+                        if event[1] in self._workers:
+                            self._stats[event[1]] = event[2]
+            except Queue.Empty:
+                pass
+            except:
+                traceback.print_exc()
+            if time.time() - last_check >= WORKER_CHECK_FREQ:
+                last_check = time.time()
+                try:
+                    self.check_workers()
+                except:
+                    traceback.print_exc()
+
+def worker_main(index, commands, events):
+    """Entry point of a worker process: schedule and run the checks the supervisor assigns"""
+
+    global CLI, SCHEDULER, ROUTINE_CACHE, RESULTS, HISTORY, BREAKER, REPORTER
+    threading.current_thread().name = 'worker-' + str(index)
+    parent = os.getppid()
+    # nothing that holds sockets or threads survives the fork usefully, and a worker
+    # restarted while the supervisor runs may inherit a lock some other thread held
+    CLI = client.Client(base_url=DOCKER_URL)
+    BREAKER = configure_breaker(ss_utils.CircuitBreaker(), CFG)
+    REPORTER = make_reporter(CFG)
+    METRICS._lock = threading.Lock()
+    RESULTS = ResultPipe(events)
+    HISTORY = HistoryPipe(events) if CFG.get('result-store', {}).get('enabled', False) else None
+    ROUTINE_CACHE = make_routine_cache()
+    SCHEDULER = make_scheduler()
+    SCHEDULER.start()
+    metrics_params = CFG.get('metrics', {})
+    if metrics_params.get('enabled', False):
+        ss_utils.serve_metrics(METRICS, metrics_params.get('port', METRICS_PORT) + 1 + index)
+
+    def report():
+        if os.getppid() != parent:
+            log('supervisor exited, stopping')
+            os._exit(0)
+        events.put(('stats', index, SCHEDULER.stats()))
+    t = ss_utils.TaskTimer(WORKER_STATS_FREQ, report)
+    t.daemon = True
     t.start()
 
+    containers = {}
+    while 1:
+        command = commands.get()
+        action, name = command[0], command[1]
+        if action == 'configure':
+            apply_config(command[1])
+        elif action == 'schedule':
+            container_obj, freq = command[2], command[3]
+            SCHEDULER.cancel(name)
+            # a container scheduled again may have been recreated with a different routine file
+            ROUTINE_CACHE.invalidate(container_obj['Id'])
+            containers[name] = container_obj
+            schedule_check(container_obj, freq)
+        elif action == 'reschedule':
+            SCHEDULER.reschedule(name, command[2])
+        elif action == 'cancel':
+            SCHEDULER.cancel(name)
+            container_obj = containers.pop(name, None)
+            if container_obj is not None:
+                ROUTINE_CACHE.invalidate(container_obj['Id'])
+            BREAKER.forget(name)
+            if REPORTER is not None:
+                REPORTER.forget(name)
+            METRICS.forget('container', name)
+        elif action == 'forget':
+            if REPORTER is not None:
+                REPORTER.forget(name)
+
+# config
+
+def make_plugins(cfg):
+    plugin_params = cfg.get('plugins', {})
+    plugins = routine_runner.PluginRegistry(plugin_params.get('dirs', ['/usr/local/nagios-plugins/']))
+    plugins.warm(plugin_params.get('warm', []))
+    return plugins
+
+def connect_server(server_params):
+    log('connecting to server: ' + json.dumps(server_params))
+    # a pool of its own, so it can be dropped when the server moves
+    return ss_utils.RestHelper(server_params['address'], server_params['port'], secure=server_params['secure'], pool=ss_utils.ConnectionPool())
+
+def apply_config(cfg):
+    """Switch to cfg the parts of the config that checks read while they run"""
+    global CFG, REPORTER
+    old, CFG = CFG, cfg
+    if cfg['routine-file'] != old['routine-file']:
+        log('routine-file changed to ' + cfg['routine-file'])
+        ROUTINE_CACHE.clear()
+    if cfg.get('plugins') != old.get('plugins'):
+        routine_runner.PLUGINS = make_plugins(cfg)
+    configure_breaker(BREAKER, cfg)
+    if cfg.get('result-reporting') != old.get('result-reporting'):
+        REPORTER = make_reporter(cfg)
+
+def reload_config():
+    """Load the config file again and apply what changed, without touching checks that aren't affected"""
+    global FREQUENCIES, server_conn
+
+    try:
+        cfg = ss_utils.load_json_template(CFG_FILE, os.environ)
+        frequencies = FrequencyRules(cfg['frequencies'])
+    except:
+        traceback.print_exc()
+        log('unable to load ' + CFG_FILE + ', keeping the current config')
+        return
+    old = CFG
+    if cfg == old:
+        debug('config unchanged')
+        return
+
+    log('reloading config ' + CFG_FILE)
+    for key in RESTART_KEYS:
+        if cfg.get(key) != old.get(key):
+            log('change to ' + key + ' takes effect when the agent is restarted')
+    with CONTAINERS_LOCK:
+        apply_config(cfg)
+        if isinstance(SCHEDULER, WorkerPool):
+            SCHEDULER.configure(cfg)
+        server_changed = cfg['server'] != old['server']
+        if server_changed:
+            old_conn, server_conn = server_conn, connect_server(cfg['server'])
+            old_conn.pool.clear()
+        if get_update_freq(cfg) != get_update_freq(old):
+            UPDATE_TIMER.set_interval(get_update_freq(cfg))
+        FREQUENCIES = frequencies
+    # reschedules only the containers whose frequency changed, and posts clients to a new server
+    if server_changed or cfg['frequencies'] != old['frequencies']:
+        update()
+
+def watch_config():
+    """Reload the config whenever the file changes or SIGHUP is received"""
+
+    mtime = os.path.getmtime(CFG_FILE)
+    while 1:
+        # a timed wait, so the SIGHUP handler gets to run in this (the main) thread
+        RELOAD.wait(CONFIG_CHECK_FREQ)
+        requested = RELOAD.isSet()
+        RELOAD.clear()
+        try:
+            current = os.path.getmtime(CFG_FILE)
+        except OSError:
+            continue
+        if requested or current != mtime:
+            mtime = current
+            try:
+                reload_config()
+            except:
+                traceback.print_exc()
+
+def get_update_freq(cfg):
+    # with docker events, update() only reconciles
+    if EVENTS_ENABLED:
+        return cfg.get('reconcile-freq', 300)
+    return cfg['update-freq']
+
+def configure_breaker(breaker, cfg):
+    breaker_params = cfg.get('circuit-breaker', {})
+    breaker.threshold = breaker_params.get('threshold', 3)
+    breaker.max_delay = breaker_params.get('max-backoff', 300)
+    return breaker
+
+def make_reporter(cfg):
+    """A ResultReporter if only changes are to be reported, else None"""
+    reporting_params = cfg.get('result-reporting', {})
+    if not reporting_params.get('changes-only', False):
+        return None
+    return ResultReporter(heartbeat=reporting_params.get('heartbeat', 300), keepalive=reporting_params.get('keepalive', 60))
+
+def make_routine_cache():
+    cache_params = CFG.get('routine-cache', {})
+    return RoutineCache(fetch_routine_file, revalidate_freq=cache_params.get('revalidate-freq', 300), max_routines=cache_params.get('max-routines', 100))
+
+def make_scheduler():
+    scheduler_params = CFG.get('scheduler', {})
+    return ss_utils.Scheduler(workers=scheduler_params.get('workers', 8), jitter=scheduler_params.get('jitter', 0.1))
+
 
 if __name__ == '__main__':
 
     log('connecting to docker daemon')
-    CLI = client.Client(base_url='unix://var/run/docker.sock')
+    CLI = client.Client(base_url=DOCKER_URL)
 
     log('loading/resolving agent config ' + CFG_FILE)
 
     CFG = ss_utils.load_json_template(CFG_FILE, os.environ)
+    FREQUENCIES = FrequencyRules(CFG['frequencies'])
+    CONTAINERS_LOCK = threading.RLock()
+    CONTAINER_IDS = {} # container id -> name of every container with a scheduled check
     HOSTNAME = CLI.info()['Name']
     ENV = os.environ.get('HOST_ENV', 'dev')
     if not os.path.exists(ROUTINES):
         log('creating dir: ' + ROUTINES)
         os.mkdir(ROUTINES)
-    CHECK_TIMERS = {}
 
-    server_params = CFG['server']
-    log('connecting to server: ' + json.dumps(server_params))
-    server_conn = ss_utils.RestHelper(server_params['address'], server_params['port'], secure=server_params['secure'])
- 
-    t = ss_utils.TaskTimer(CFG['update-freq'], update)
-    t.start()
+    routine_runner.PLUGINS = make_plugins(CFG)
+    routine_runner.ON_EXEC = lambda seconds: METRICS.observe('docker_duration_seconds', seconds, ('exec',))
+
+    ROUTINE_CACHE = make_routine_cache()
+    # containers whose checks keep failing outright are checked less and less often
+    BREAKER = configure_breaker(ss_utils.CircuitBreaker(), CFG)
+    # with changes-only reporting, stable containers only post now and then
+    REPORTER = make_reporter(CFG)
+
+    # with worker-processes set, checks run in that many processes (each with its own
+    # scheduler) and this one only tracks containers and posts to the server
+    processes = CFG.get('worker-processes', 0)
+    if processes > 0:
+        log('starting ' + str(processes) + ' worker processes')
+        SCHEDULER = WorkerPool(processes)
+    else:
+        SCHEDULER = make_scheduler()
+    SCHEDULER.start()
+
+    server_conn = connect_server(CFG['server'])
+
+    # every task result is kept on disk for a while when the result store is enabled
+    store_params = CFG.get('result-store', {})
+    if store_params.get('enabled', False):
+        HISTORY = ss_utils.ResultStore(store_params.get('dir', 'results_store/'), segment_seconds=store_params.get('segment-minutes', 60) * 60, retention=store_params.get('retention-hours', 24) * 3600)
+
+    # check results are queued by the check workers and posted by separate sender threads,
+    # only the newest result per container is kept while waiting
+    sender_params = CFG.get('result-sender', {})
+    RESULTS = ss_utils.CoalescingQueue(sender_params.get('queue-size', 1000), on_drop=result_dropped)
+    for i in range(sender_params.get('workers', 2)):
+        threading.Thread(target=send_results, name='sender-' + str(i)).start()
+
+    metrics_params = CFG.get('metrics', {})
+    if metrics_params.get('enabled', False):
+        METRICS.gauge('threads', 'Live threads', threading.active_count)
+        METRICS.gauge('result_queue_depth', 'Check results waiting to be posted', RESULTS.qsize)
+        METRICS.gauge('results_dropped_total', 'Check results dropped because the queue was full', lambda: RESULTS.stats()['dropped'], kind='counter')
+        METRICS.gauge('results_coalesced_total', 'Check results replaced by a newer one before being posted', lambda: RESULTS.stats()['coalesced'], kind='counter')
+        METRICS.gauge('scheduled_checks', 'Containers with a scheduled check', lambda: SCHEDULER.stats()['tasks'])
+        METRICS.gauge('scheduler_queued', 'Checks due and waiting for a worker', lambda: SCHEDULER.stats()['queued'])
+        METRICS.gauge('scheduler_max_lag_seconds', 'How far behind schedule the latest checks started', lambda: SCHEDULER.stats()['max-lag'])
+        METRICS.gauge('scheduler_overruns_total', 'Checks that ran longer than their interval', lambda: SCHEDULER.stats()['overruns'], kind='counter')
+        METRICS.gauge('circuits_open', 'Containers whose checks are backed off after failing', lambda: BREAKER.stats()['open'])
+        METRICS.gauge('routine_cache_routines', 'Parsed routines in the cache', lambda: ROUTINE_CACHE.stats()['routines'])
+        port = metrics_params.get('port', METRICS_PORT)
+        log('serving metrics on port ' + str(port))
+        ss_utils.serve_metrics(METRICS, port, routes={'/history': query_history} if HISTORY is not None else None)
+
+    EVENTS_ENABLED = CFG.get('docker-events', False)
+    if EVENTS_ENABLED:
+        # containers are tracked from events, a slow full update only reconciles anything missed
+        t = threading.Thread(target=watch_events, name='events')
+        t.start()
+    UPDATE_TIMER = ss_utils.TaskTimer(get_update_freq(CFG), update)
+    UPDATE_TIMER.start()
+
+    RELOAD = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: RELOAD.set())
+    watch_config()
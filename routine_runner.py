@@ -10,28 +10,42 @@ import re
 import copy
 import abc
 import traceback
+import socket
+import threading
+import Queue
+import math
+import time
+import argparse
 
 
 # constants
 LOG_LEVEL = 1
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 DEFAULT_TASK_TYPE = 'http'
+MAX_CONCURRENCY = 50
+DEFAULT_REQUEST_TIMEOUT = 10 # seconds, used when a task has no critical-threshold
+DEFAULT_COMMAND_TIMEOUT = 30 # seconds
+MAX_COMMAND_OUTPUT = 64 * 1024 # bytes kept per output stream of execute and plugin tasks
+MAX_RESPONSE_SIZE = 10 * 1024 * 1024 # bytes of http response body read when looking for fields
+ERROR_BODY_LIMIT = 4096 # bytes of an unexpected http response included in the result detail
+DEFAULT_PARALLELISM = 4 # tasks of a routine run at once when their dependencies allow
+TASK_THREADS = 32 # threads shared by the tasks of every routine run in this process
+INSTANCE_THREADS = 2 * MAX_CONCURRENCY # threads shared by the concurrent instances of every task
+MACRO_PATTERN = re.compile(r'<\w+:[\w\:]+>')
+ON_EXEC = None # if set, called with the seconds every docker exec of an execute task took
 
 # helpers
 def log(msg, lvl=1, obj=False, pretty=False):
     if LOG_LEVEL >= lvl:
         if obj:
             indent = 4 if pretty else None
-            msg = json.dumps(msg, indent=indent)
+            msg = json.dumps(msg, indent=indent, default=str)
         sys.stderr.write(msg + '\n')
 
 def log_obj(obj, lvl=1):
     log(obj.__class__.__name__ + ' object created as:')
     log(vars(obj), lvl=lvl, obj=True)
 
-def find_file(name_pattern, dir_path):
-    return [ f for f in os.listdir(dir_path) if re.match(pattern, f) ]
-
 #def results_to_html(results):
 #    res_cp = copy.deepcopy(results)
 #    for result in res_cp['task-results']:
@@ -47,6 +61,54 @@ def get_task(task_type):
             return t
     return None
 
+# macros
+
+def macro_scope(macro):
+    """Scope a (class, name, args) macro is cached in, general macros name it in their first argument"""
+    if macro[0] != 'general':
+        return None
+    return macro[2][0] if macro[2] else 'routine'
+
+class Template(object):
+    """A string containing macros, split once into literal text and macro references
+
+    Macros look like <class:name:arg...>, e.g. <task:login:token> or
+    <general:rand_string>. Rendering substitutes every macro in a single pass.
+    """
+
+    def __init__(self, string):
+        self.string = string
+        self.parts = []     # literal strings and (macro class, name, args) tuples
+        self.macros = []
+        pos = 0
+        for m in MACRO_PATTERN.finditer(string or ''):
+            if m.start() > pos:
+                self.parts.append(string[pos:m.start()])
+            chunks = m.group()[1:-1].split(':')
+            macro = (chunks[0], chunks[1], tuple(chunks[2:]))
+            self.parts.append(macro)
+            self.macros.append(macro)
+            pos = m.end()
+        if pos < len(string or ''):
+            self.parts.append(string[pos:])
+        # rendered separately for every instance of a task
+        self.per_instance = 'instance' in [ macro_scope(macro) for macro in self.macros ]
+
+    def __str__(self):
+        return str(self.string)
+
+    def refs(self, macro_class, scope=None):
+        """Names of the macros of macro_class, only those cached in scope if given"""
+        return [ macro[1] for macro in self.macros if macro[0] == macro_class and scope in (None, macro_scope(macro)) ]
+
+    def render(self, runtime):
+        if not self.macros:
+            return self.string
+        res = ''.join([ part if isinstance(part, basestring) else runtime.expand_macro(*part) for part in self.parts ])
+        if LOG_LEVEL >= 2:
+            log('string ' + self.string + ' expanded to: ' + res, 2)
+        return res
+
 # task
 
 class Task(object):
@@ -62,9 +124,16 @@ class Task(object):
             self.description = cfg['description']
             self.enabled = cfg.get('enabled', True)
             self.instances = cfg.get('instances', 1)
+            self.depends_on = cfg.get('depends-on', [])
         except KeyError:
             raise ValueError('the following are required for all task definitons: ' + ','.join(self.required_fields_general))
+        if not isinstance(self.depends_on, list):
+            self.depends_on = [self.depends_on]
+        # number of instances allowed in flight at once
+        self.concurrency = min(cfg.get('concurrency', 1), self.instances, MAX_CONCURRENCY)
         self.start_time, self.end_time = None, None
+        self.duration = None
+        self.latency = None
 
         # check task specific required fields
         for f in self.required_fields:
@@ -79,11 +148,79 @@ class Task(object):
     def run(self, host, runtime):
         return
 
+    def macro_templates(self):
+        """Templates of the fields of this task that get macros expanded when it runs"""
+        return []
+
+    def macro_refs(self, macro_class, scope=None):
+        """Names of the macros of macro_class (e.g. 'task' or 'general') this task uses, see Template.refs"""
+        refs = []
+        for template in self.macro_templates():
+            for name in template.refs(macro_class, scope):
+                if name not in refs:
+                    refs.append(name)
+        return refs
+
+    @property
+    def per_instance(self):
+        """True if some macro of this task is expanded separately for every instance"""
+        return any([ template.per_instance for template in self.macro_templates() ])
+
     def start(self):
         self.start_time = ss_utils.get_current_time()
+        self.start_clock = ss_utils.monotonic()
+        self.duration = None
+        self.latency = ss_utils.Histogram() # microseconds per instance
 
     def end(self):
         self.end_time = ss_utils.get_current_time()
+        self.duration = ss_utils.monotonic() - self.start_clock
+        # tasks that don't time their instances count as one instance
+        if self.latency.count == 0:
+            self.record_instance(self.duration)
+
+    def record_instance(self, seconds):
+        self.latency.record(seconds * 1000000)
+
+    def run_instances(self, run_instance):
+        """Call run_instance(i) for every instance, up to self.concurrency at once, and time each call
+
+        Returns the TaskResult of a single instance, or one combining all of them.
+        """
+        durations = [None] * self.instances
+
+        def timed(i):
+            start = ss_utils.monotonic()
+            try:
+                return run_instance(i)
+            finally:
+                durations[i] = ss_utils.monotonic() - start
+
+        self.start()
+        results = ss_utils.parallel_map(timed, range(self.instances), self.concurrency, pool=INSTANCE_POOL)
+        for d in durations:
+            self.record_instance(d)
+        self.end()
+
+        if len(results) == 1:
+            return results[0]
+        return TaskResult.from_instances(results)
+
+    def command_result(self, res, stream):
+        """TaskResult for the (exit code, CommandOutput) of a command, reporting output[stream] on failure"""
+        ret, output = res
+        if ret == 0:
+            return TaskResult(TaskResult.SUCCESS, 'OK')
+        elif output.truncated:
+            return TaskResult(TaskResult.OUTPUT_TRUNCATED, output[stream])
+        else:
+            return TaskResult(TaskResult.UNCLASSIFIED_ERROR, output[stream])
+
+    def timeout_result(self, e, stream):
+        detail = 'command did not finish within ' + str(self.timeout) + ' seconds'
+        if e.output is not None and e.output[stream]:
+            detail += ', output: ' + e.output[stream]
+        return TaskResult(TaskResult.COMMAND_TIMEOUT, detail)
 
 
 # task implementations
@@ -102,6 +239,8 @@ class execute(Task):
         self.privileged = cfg.get('privileged', False)
         self.user = cfg.get('user', None)
         self.output_stream = cfg.get('output-stream', 'stderr')
+        self.timeout = cfg.get('timeout', DEFAULT_COMMAND_TIMEOUT)
+        self.command_template = Template(self.command)
 
         log_obj(self)
 
@@ -109,38 +248,123 @@ class execute(Task):
     def required_fields(self):
         return ['command']
 
+    def macro_templates(self):
+        return [self.command_template]
+
     def run(self, host, runtime):
         log('preparing to run task: ' + self.name)
-        command = runtime.expand_macros(self.command)
-        options = ''
-        if self.user is not None:
-            options += ' --user ' + self.user
-        if self.privileged:
-            options += ' --privileged'
-        
-        full_cmd = 'docker exec' + options + ' ' + host.cfg['container-name'] + ' ' + command
-        log('running command: ' + full_cmd)
-
-        self.start()
-        res = ss_utils.run_cmd(full_cmd, get_output=True)
-        self.end()
-
-        ret = res[0]
-        if ret == 0:
-            return TaskResult(TaskResult.SUCCESS, 'OK')
+        # a command with <general:...:instance> macros differs per instance, others are expanded once
+        command = None if self.per_instance else self.command_template.render(runtime)
+        container = host.cfg['container-name']
+
+        if runtime.docker_client is not None:
+            def execute_command(command):
+                log('running command in ' + container + ' through the docker API: ' + command)
+                return ss_utils.docker_exec(runtime.docker_client, container, command, user=self.user, privileged=self.privileged, timeout=self.timeout, max_output=MAX_COMMAND_OUTPUT)
         else:
-            stream = self.output_streams[self.output_stream]
-            return TaskResult(TaskResult.UNCLASSIFIED_ERROR, res[1][stream]) # res[1][0] for stdout, res[1][1] for stderr
+            # no API client, fork the docker CLI instead
+            options = ''
+            if self.user is not None:
+                options += ' --user ' + self.user
+            if self.privileged:
+                options += ' --privileged'
+
+            def execute_command(command):
+                full_cmd = 'docker exec' + options + ' ' + container + ' ' + command
+                log('running command: ' + full_cmd)
+                return ss_utils.run_cmd(full_cmd, get_output=True, timeout=self.timeout, max_output=MAX_COMMAND_OUTPUT)
+
+        stream = self.output_streams[self.output_stream] # 0 for stdout, 1 for stderr
+
+        def run_instance(i):
+            instance_command = command or self.command_template.render(runtime.instance())
+            start = ss_utils.monotonic()
+            try:
+                res = execute_command(instance_command)
+            except ss_utils.CommandTimeout as e:
+                return self.timeout_result(e, stream)
+            finally:
+                if ON_EXEC is not None:
+                    ON_EXEC(ss_utils.monotonic() - start)
+            return self.command_result(res, stream)
+
+        return self.run_instances(run_instance)
+
+class PluginRegistry(object):
+    """Index of plugin name -> executable path over one or more plugin directories
+
+    A plugin can be looked up by its file name or by its file name without the
+    extension (check_disk for check_disk.pl), earlier directories winning. The index
+    is rebuilt when a directory's mtime changes, checked at most every
+    refresh_freq seconds, so a lookup is normally a single dict access.
+    """
+
+    def __init__(self, dirs, refresh_freq=10):
+        self.dirs = dirs
+        self.refresh_freq = refresh_freq
+        self.index = {}
+        self.mtimes = {}
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        now = ss_utils.monotonic()
+        with self.lock:
+            if not force and self.checked is not None and now - self.checked < self.refresh_freq:
+                return
+            self.checked = now
+            mtimes = {}
+            for d in self.dirs:
+                try:
+                    mtimes[d] = os.stat(d).st_mtime
+                except OSError:
+                    mtimes[d] = None
+            if not force and mtimes == self.mtimes:
+                return
+            index = {}
+            stripped = {}
+            for d in self.dirs:
+                if mtimes[d] is None:
+                    continue
+                for f in sorted(os.listdir(d)):
+                    path = os.path.join(d, f)
+                    if not os.path.isfile(path) or not os.access(path, os.X_OK):
+                        continue
+                    index.setdefault(f, path)
+                    stripped.setdefault(os.path.splitext(f)[0], path)
+            # exact file names take precedence over names without extension
+            for name, path in stripped.items():
+                index.setdefault(name, path)
+            log('indexed ' + str(len(index)) + ' plugin names in ' + ','.join(self.dirs))
+            self.index, self.mtimes = index, mtimes
+
+    def find(self, name):
+        self.refresh()
+        return self.index.get(name)
+
+    def warm(self, names):
+        """Resolve plugins ahead of their first use and pull their files into the page cache"""
+        self.refresh(force=True)
+        for name in names:
+            path = self.index.get(name)
+            if path is None:
+                log('WARNING: plugin to warm not found: ' + name)
+                continue
+            with open(path, 'rb') as f:
+                while f.read(65536):
+                    pass
+
+# plugin directories searched by plugin tasks, monitor_agent replaces this from its config
+PLUGINS = PluginRegistry(['/usr/local/nagios-plugins/'])
 
 class plugin(Task):
 
-    PLUGINS_DIR = '/usr/local/nagios-plugins/'
-
     def __init__(self, cfg):
         Task.__init__(self, cfg)
 
         self.plugin_name = cfg['plugin-name']
         self.args = cfg.get('args', {})
+        self.timeout = cfg.get('timeout', DEFAULT_COMMAND_TIMEOUT)
 
         log_obj(self)
 
@@ -151,24 +375,24 @@ class plugin(Task):
     def run(self, host, runtime):
         log('preparing to run task: ' + self.name)
 
-        files = find_file('^.*/' + self.plugin_name + '\..+$', self.PLUGINS_DIR)
-        if len(files) < 1:
-            raise ValueError('unable to find plugin ' + self.plugin_name + ' in ' + self.PLUGINS_DIR)
-        cmd = files[0]
+        path = PLUGINS.find(self.plugin_name)
+        if path is None:
+            raise ValueError('unable to find plugin ' + self.plugin_name + ' in ' + ','.join(PLUGINS.dirs))
+        cmd = [path]
         for k,v in self.args.items():
-            cmd += ' ' + k + ' ' + str(v)
+            cmd += [k, str(v)]
 
-        log('running command: ' + cmd)
+        log('running command: ' + ' '.join(cmd))
         
         self.start()
-        res = ss_utils.run_cmd(cmd, get_output=True)
-        self.end()
+        try:
+            res = ss_utils.run_cmd(cmd, get_output=True, timeout=self.timeout, max_output=MAX_COMMAND_OUTPUT)
+        except ss_utils.CommandTimeout as e:
+            return self.timeout_result(e, 0)
+        finally:
+            self.end()
 
-        ret = res[0]
-        if ret == 0:
-            return TaskResult(TaskResult.SUCCESS, 'OK')
-        else:
-            return TaskResult(TaskResult.UNCLASSIFIED_ERROR, res[1][0]) # stdout
+        return self.command_result(res, 0) # stdout
 
 
 class http(Task):
@@ -192,13 +416,32 @@ class http(Task):
         self.expected_response_field = response.get('expected-response-field', None)
         self.expected_response_value = response.get('expected-response-field-value', None)
         self.save_field = response.get('save-field', None)
+        self.max_response_size = response.get('max-response-size', MAX_RESPONSE_SIZE)
+        # fields looked up in the response body, a task without any never reads it
+        fields = [ f for f in (self.save_field, self.expected_response_field) if f is not None ]
+        self.extractor = ss_utils.JsonExtractor(fields) if fields else None
+
+        self.uri_template = Template(self.uri)
+        self.data_template = Template(self.data)
+        self.auth_template = Template(self.auth)
+        self.expected_value_template = Template(self.expected_response_value)
 		
         self.seconds_to_response_warning = response.get('warning-threshold', None)
         self.seconds_to_response_error = response.get('critical-threshold', None)
+        if self.seconds_to_response_warning is not None:
+            self.seconds_to_response_warning = float(self.seconds_to_response_warning)
+        if self.seconds_to_response_error is not None:
+            self.seconds_to_response_error = float(self.seconds_to_response_error)
+        # requests are abandoned once the critical threshold has passed
+        self.timeout = DEFAULT_REQUEST_TIMEOUT if self.seconds_to_response_error is None else self.seconds_to_response_error
 
         # enforce some contstraints
         if self.instances > 1 and self.save_field is not None:
             raise ValueError('cannot define a task with multiple instances and a save-field')
+        if self.save_field is not None and ss_utils.compile_xpath(self.save_field).multi:
+            raise ValueError('save-field cannot contain a * or a [key=value] filter')
+        if None not in (self.seconds_to_response_warning, self.seconds_to_response_error) and self.seconds_to_response_warning > self.seconds_to_response_error:
+            raise ValueError('warning-threshold cannot be greater than critical-threshold')
 		
         log_obj(self)
 
@@ -206,62 +449,105 @@ class http(Task):
     def required_fields(self):
         return []
 
+    def macro_templates(self):
+        return [self.uri_template, self.data_template, self.auth_template, self.expected_value_template]
+
+    def render(self, scope):
+        """uri, data, auth and expected value with the macros of scope expanded"""
+        expected_value = None
+        if self.expected_response_field is not None:
+            expected_value = self.expected_value_template.render(scope)
+        fields = (self.uri_template.render(scope), self.data_template.render(scope), self.auth_template.render(scope), expected_value)
+        log('running with: uri ' + fields[0] + ', method ' + self.method + ', auth ' + fields[2] + ', data ' + fields[1] + ', expected status ' + str(self.expected_status_range) + ', instances ' + str(self.instances) + ', concurrency ' + str(self.concurrency))
+        return fields
+
     def run(self, host, runtime):
         log('preparing to run task: ' + self.name)
-        name = self.name
-        uri = runtime.expand_macros(self.uri)
-        method = self.method
-        data = runtime.expand_macros(self.data)
-        content_type = self.content_type
-        expected_status_lower = self.expected_status_lower
-        expected_status_upper = self.expected_status_upper
-        auth = runtime.expand_macros(self.auth)
+        # fields with <general:...:instance> macros differ per instance, others are expanded once
+        fields = None if self.per_instance else self.render(runtime)
+        restHelper = runtime.rest_helper(host)
+
+        def run_instance(i):
+            scope = runtime if fields is not None else runtime.instance()
+            uri, data, auth, expected_value = fields or self.render(scope)
+            start = ss_utils.monotonic()
+            try:
+                # the whole response, body included, has to arrive within the timeout
+                response = restHelper.request(self.method, uri, data=data, content_type=self.content_type, auth=auth, timeout=self.timeout, stream=True, deadline=start + self.timeout)
+            except socket.timeout:
+                return TaskResult(TaskResult.LATENCY_CRITICAL, 'no response within ' + str(self.timeout) + ' seconds')
+            except Exception as e:
+                return TaskResult(TaskResult.UNCLASSIFIED_ERROR, 'Task Exception: ' + str(e))
+            try:
+                try:
+                    result = self.check_response(response, scope, expected_value)
+                finally:
+                    response.release()
+            except socket.timeout:
+                return TaskResult(TaskResult.LATENCY_CRITICAL, 'response body not received within ' + str(self.timeout) + ' seconds')
+            # latency is up to the end of the body, not just the headers
+            duration = ss_utils.monotonic() - start
+            if result.code == 0:
+                result = self.check_latency(duration)
+            return result
 
-        log('running with: uri ' + uri + ', method ' + method + ', auth ' + auth + ', data ' + data + ', expected status ' + str(self.expected_status_range))
+        return self.run_instances(run_instance)
 
-        self.start()
-        for i in range(self.instances):
-            if host.name not in runtime.values:
-                hostname = host.cfg['hostname']
-                port = host.cfg.get('port', None)
-                secure = host.cfg.get('secure', False)
-                check_cert = host.cfg.get('check-cert', True)
-                runtime.values[host.name] = ss_utils.RestHelper(hostname, port, secure, check_cert=check_cert)
-            restHelper = runtime.values[host.name]
-            response = restHelper.request(method, uri, data=data, content_type=content_type, auth=auth)
-        self.end()
+    def check_latency(self, seconds):
+        for threshold, result in ((self.seconds_to_response_error, TaskResult.LATENCY_CRITICAL), (self.seconds_to_response_warning, TaskResult.LATENCY_WARNING)):
+            if threshold is not None and seconds > threshold:
+                result_detail = 'response took ' + str(round(seconds, 3)) + ' seconds, threshold is ' + str(threshold) + ' seconds'
+                return TaskResult(result, result_detail)
+        return TaskResult(TaskResult.SUCCESS, 'OK')
 
-        if not expected_status_lower <= response.status <= expected_status_upper:
-            result_detail = 'expected status ' + str(self.expected_status_range) + ', got ' + str(response.status) + ', response: ' + response.read()
+    def check_response(self, response, runtime, expected_value):
+        if not self.expected_status_lower <= response.status <= self.expected_status_upper:
+            result_detail = 'expected status ' + str(self.expected_status_range) + ', got ' + str(response.status) + ', response: ' + response.read(ERROR_BODY_LIMIT)
             return TaskResult(TaskResult.UNEXPECTED_HTTP_STATUS, result_detail)
 
+        if self.extractor is None:
+            return TaskResult(TaskResult.SUCCESS, 'OK')
+
         try:
-            response_json = json.loads(response.read())
-        except:
-            response_json = None
+            fields = self.extractor.extract(response.read, max_size=self.max_response_size)
+        except ss_utils.ResponseTooLarge as e:
+            return TaskResult(TaskResult.RESPONSE_TOO_LARGE, str(e))
+        except ValueError:
+            # not JSON, none of the fields can be found
+            fields = {}
 
-        log('response: ' + str(response_json))
+        log('response fields: ' + str(fields))
 
         save_field = self.save_field
         if save_field is not None:
             log('saving value for response field ' + save_field)
-            value = ss_utils.xpath_get(response_json, save_field)
-            if value is None:
+            value = fields.get(save_field, ss_utils.MISSING)
+            if value is ss_utils.MISSING:
                 result_detail = 'expected but could not find key in response: ' + save_field
                 return TaskResult(TaskResult.EXPECTED_KEY_NOT_FOUND, result_detail)
+            if value is None:
+                result_detail = 'expected a value but key is null in response: ' + save_field
+                return TaskResult(TaskResult.EXPECTED_KEY_NOT_FOUND, result_detail)
             runtime.save_value(self, save_field, value)
 
         expected_response_field = self.expected_response_field
         if expected_response_field is not None:
-            expected_response_value = runtime.expand_macros(self.expected_response_value)
-            log('looking for value ' + expected_response_value)
-            value = ss_utils.xpath_get(response_json, expected_response_field)
-            if value is None:
+            log('looking for value ' + expected_value)
+            value = fields.get(expected_response_field, ss_utils.MISSING)
+            multi = ss_utils.compile_xpath(expected_response_field).multi
+            # a wildcard or filter that matches nothing finds no key, a field that is [] is a value
+            if value is ss_utils.MISSING or (multi and value == []):
                 result_detail = 'expected but could not find key in response: ' + expected_response_field
                 return TaskResult(TaskResult.EXPECTED_KEY_NOT_FOUND, result_detail)
-            if value != expected_response_value:
-                result_detail = 'value "' + str(value) + '" does not match expected value "' + str(expected_response_value) + '" in response field "' + expected_response_field + '"'
-                return (TaskResult.EXPECTED_VALUE_NOT_FOUND, result_detail)
+            if multi:
+                # every match has to have the expected value
+                mismatched = [ v for v in value if not ss_utils.json_value_matches(v, expected_value) ]
+                if mismatched:
+                    result_detail = str(len(mismatched)) + ' of ' + str(len(value)) + ' values in response field "' + expected_response_field + '" do not match expected value "' + str(expected_value) + '", first: ' + json.dumps(mismatched[0])
+                    return TaskResult(TaskResult.EXPECTED_VALUE_NOT_FOUND, result_detail)
+            elif not ss_utils.json_value_matches(value, expected_value):
+                result_detail = 'value ' + json.dumps(value) + ' does not match expected value "' + str(expected_value) + '" in response field "' + expected_response_field + '"'
+                return TaskResult(TaskResult.EXPECTED_VALUE_NOT_FOUND, result_detail)
 
         return TaskResult(TaskResult.SUCCESS, 'OK')
 
@@ -274,6 +560,11 @@ class TaskResult(object):
     UNEXPECTED_HTTP_STATUS = {'name': 'UNEXPECTED_HTTP_STATUS', 'code': 1, 'color': 'red'}
     EXPECTED_KEY_NOT_FOUND = {'name': 'EXPECTED_KEY_NOT_FOUND', 'code': 2, 'color': 'red'}
     EXPECTED_VALUE_NOT_FOUND = {'name': 'EXPECTED_VALUE_NOT_FOUND', 'code': 3, 'color':'red'}
+    LATENCY_WARNING = {'name': 'LATENCY_WARNING', 'code': 4, 'color': 'orange', 'warning': True}
+    LATENCY_CRITICAL = {'name': 'LATENCY_CRITICAL', 'code': 5, 'color': 'red'}
+    COMMAND_TIMEOUT = {'name': 'COMMAND_TIMEOUT', 'code': 6, 'color': 'red'}
+    OUTPUT_TRUNCATED = {'name': 'OUTPUT_TRUNCATED', 'code': 7, 'color': 'red'}
+    RESPONSE_TOO_LARGE = {'name': 'RESPONSE_TOO_LARGE', 'code': 8, 'color': 'red'}
         # add more results here
     UNCLASSIFIED_ERROR = {'name': 'UNCLASSIFIED_ERROR', 'code': 8675309, 'color': 'red'}
     
@@ -282,11 +573,33 @@ class TaskResult(object):
         self.result_name = result['name']
         self.code = result['code']
         self.detail = detail
+        self.warning = result.get('warning', False)
+        self.passed = self.code == 0 or self.warning
+        self.instances_passed = 1 if (self.code == 0 or self.warning) else 0
+        self.instances_failed = 1 if (self.code > 0 and not self.warning) else 0
         log_obj(self)
 
+    @classmethod
+    def from_instances(cls, results):
+        """Collapse the results of every instance of a task into one that reports the first failure"""
+        failed = [ res for res in results if res.code > 0 and not res.warning ]
+        warned = [ res for res in results if res.warning ]
+        if failed:
+            detail = str(len(failed)) + ' of ' + str(len(results)) + ' instances failed, first failure: ' + str(failed[0].detail)
+            res = cls(failed[0].result, detail)
+        elif warned:
+            detail = str(len(warned)) + ' of ' + str(len(results)) + ' instances raised a warning, first warning: ' + str(warned[0].detail)
+            res = cls(warned[0].result, detail)
+        else:
+            res = cls(cls.SUCCESS, 'OK')
+        res.instances_passed = len(results) - len(failed)
+        res.instances_failed = len(failed)
+        return res
+
 class Routine(object):
     def __init__(self, cfg):
         self.name = cfg['name']
+        self.parallelism = cfg.get('parallelism', DEFAULT_PARALLELISM)
         self.tasks = []
         log('-- creating routine: ' + self.name)
         for task in cfg['tasks']:
@@ -300,6 +613,38 @@ class Routine(object):
             except Exception as e:
                 log('ERROR in creating routine:')
                 traceback.print_exc()
+        self.dependencies, self.ordering = self.get_dependencies()
+
+    def get_dependencies(self):
+        """For each task, the indices of the earlier tasks it depends on and of those it only runs after
+
+        A task depends on the tasks named in its depends-on field or in its
+        <task:name:key> macros, and is skipped if one of them does not pass.
+        It runs after the previous task that used any of the same routine
+        scoped <general:...> macros, in declaration order, whatever that
+        task's result, since the two only share a generated value.
+        """
+        index = {}
+        general_users = {}
+        dependencies = []
+        ordering = []
+        for i, task in enumerate(self.tasks):
+            deps = set()
+            after = set()
+            for name in task.depends_on + task.macro_refs('task'):
+                if name in index:
+                    deps.add(index[name])
+                else:
+                    log('WARNING: task ' + task.name + ' depends on ' + name + ', which is not defined before it')
+            # only general macros cached for the whole routine run are shared between tasks
+            for name in task.macro_refs('general', scope='routine'):
+                if name in general_users:
+                    after.add(general_users[name])
+                general_users[name] = i
+            index[task.name] = i
+            dependencies.append(deps)
+            ordering.append(after - deps)
+        return dependencies, ordering
 
 class Host(object):
     def __init__(self, cfg):
@@ -320,12 +665,67 @@ class HostSet(object):
                 log('ERROR in creating host:')
                 traceback.print_exc()
 
+# tasks wait on their instances, so the two never share a pool
+TASK_POOL = ss_utils.ThreadPool(TASK_THREADS, 'task')
+INSTANCE_POOL = ss_utils.ThreadPool(INSTANCE_THREADS, 'instance')
+
 class Runner(object):
-    def __init__(self, routine, host_set):
+    def __init__(self, routine, host_set, parallelism=None, docker_client=None):
 		# dictionary to store any values that need to persist across tasks
-        self.runtime = Runtime()
+        self.runtime = Runtime(docker_client)
         self.host_set = host_set
         self.routine = routine
+        # tasks keep per-run state, so each run works on its own copies and routines can be shared
+        self.tasks = [ copy.copy(task) for task in routine.tasks ]
+        self.parallelism = routine.parallelism if parallelism is None else parallelism
+
+    def run_task(self, task):
+        if not task.enabled:
+            return TaskResult(TaskResult.SKIPPED, 'Task marked as disabled')
+        try:
+            host = self.host_set.hosts[task.host_index]
+            return task.run(host, self.runtime.task_scope())
+        except Exception as e:
+            traceback.print_exc()
+            return TaskResult(TaskResult.UNCLASSIFIED_ERROR, 'Task Exception: ' + str(e))
+
+    def run_tasks(self):
+        """Run each task once the tasks it depends on or runs after are done, up to self.parallelism at a time
+
+        A task whose dependency did not pass is skipped. Results are returned in
+        declaration order.
+        """
+        tasks = self.tasks
+        results = [None] * len(tasks)
+        waiting = range(len(tasks))
+        finished = Queue.Queue()
+        running = 0
+
+        def run(i):
+            finished.put((i, self.run_task(tasks[i])))
+
+        while waiting or running:
+            for i in list(waiting):
+                if running >= self.parallelism:
+                    break
+                deps = self.routine.dependencies[i]
+                if any(results[d] is None for d in deps | self.routine.ordering[i]):
+                    continue
+                waiting.remove(i)
+                failed = [ tasks[d].name for d in sorted(deps) if not results[d].passed ]
+                if failed:
+                    results[i] = TaskResult(TaskResult.SKIPPED, 'dependencies did not pass: ' + ','.join(failed))
+                    continue
+                running += 1
+                if self.parallelism > 1:
+                    TASK_POOL.submit(run, i)
+                else:
+                    run(i)
+            if running:
+                i, result = finished.get()
+                results[i] = result
+                running -= 1
+        return results
 
     def run(self):
         task_results = {
@@ -335,22 +735,18 @@ class Runner(object):
             'hosts': ','.join([host.name for host in self.host_set.hosts]),
             'tasks-passed': 0,
             'tasks-failed': 0,
+            'tasks-warned': 0,
             'task-results': []
        	    }
-        for task in self.routine.tasks:
-            if task.enabled:
-                try:
-                    host = self.host_set.hosts[task.host_index]
-                    result = task.run(host, self.runtime)
-                except Exception as e:
-                    traceback.print_exc()
-                    result = TaskResult(TaskResult.UNCLASSIFIED_ERROR, 'Task Exception: ' + str(e))
-            else:
-                result = TaskResult(TaskResult.SKIPPED, 'Task marked as disabled')
+        results = self.run_tasks()
+        for task, result in zip(self.tasks, results):
             # evaluate result
             if result.code == 0:
                 task_results['tasks-passed'] += 1
                 passed = True
+            elif result.warning:
+                task_results['tasks-warned'] += 1
+                passed = True
             elif result.code > 0:
                 task_results['tasks-failed'] += 1
                 passed = False
@@ -358,75 +754,313 @@ class Runner(object):
                 passed = False
 
             start_time = 'N/A' if task.start_time is None else task.start_time.strftime(TIME_FORMAT)
-            time_diff_ms = 'N/A' if (task.start_time is None or task.end_time is None) else ss_utils.get_time_diff(task.start_time, task.end_time)
+            time_diff_ms = 'N/A' if task.duration is None else int(task.duration * 1000)
+            latency_ms = None if task.latency is None else task.latency.summary(scale=1000)
+            throughput = None if not task.duration else round(task.latency.count / task.duration, 3)
 
             task_summary = {'name': task.name,
                             'type': task.__class__.__name__,
 	                        'description': task.description,
                             'instances': task.instances,
+                            'instances-passed': result.instances_passed,
+                            'instances-failed': result.instances_failed,
                             'host-index': task.host_index,
         	                #'status_code': result.status_code,
                             'result': result.result_name,
                             'result-detail': result.detail,
                         	'task-start': start_time, 
-	                        'task-duration-ms': time_diff_ms
+	                        'task-duration-ms': time_diff_ms,
+                            'latency-ms': latency_ms,
+                            'throughput-per-sec': throughput
         	                }
             task_results['task-results'].append(task_summary)
 		
         return task_results
 
 
-class Runtime(object):
+class Scope(object):
+    """A routine run, task or task instance: what macros are expanded and values saved through
+
+    General macros are cached in the scope named by their first argument:
+    <general:rand_string> (same as <general:rand_string:routine>) is generated
+    once per routine run, <general:rand_string:task> once per task and
+    <general:rand_string:instance> once per task instance. Every scope of a
+    run shares the values saved by its tasks and its RestHelpers, see Runtime.
+    """
 
     macro_defs = {
         'rand_string': ss_utils.get_rand_string
     }
+    kinds = ('routine', 'task', 'instance')
 
-    def __init__(self):
-        self.values = {'cached': {}}
+    def __init__(self, runtime, kind, parent):
+        self.runtime = runtime
+        self.kind = kind
+        self.parent = parent
+        # docker API client used by execute tasks, they fork the docker CLI without one
+        self.docker_client = runtime.docker_client
+        self.macros = {}    # general macros cached in this scope
+        self._lock = threading.Lock()
 
-    def save_value(task, key, value):
-        log('saving value ' + str(value) + ' for key ' + key + ' for task ' + task.name)
-        if task.name in self.values:
-            self.values[task.name][key] = value
+    @property
+    def values(self):
+        """Snapshot of the values saved by tasks, task name -> {key: value}, never changed in place"""
+        return self.runtime.snapshot
+
+    def task_scope(self):
+        return Scope(self.runtime, 'task', self)
+
+    def instance(self):
+        return Scope(self.runtime, 'instance', self)
+
+    def save_value(self, task, key, value):
+        self.runtime.save(task, key, value)
+
+    def rest_helper(self, host):
+        return self.runtime.get_rest_helper(host)
+
+    def general_macro(self, name, kind):
+        scope = self
+        while scope is not None and scope.kind != kind:
+            scope = scope.parent
+        if scope is None:
+            if kind not in self.kinds:
+                raise ValueError('unrecognized macro scope: ' + kind)
+            raise ValueError('macro <general:' + name + ':' + kind + '> used outside of a ' + kind)
+        value = scope.macros.get(name)
+        if value is None:
+            # generated once even if concurrent tasks or instances ask at the same time
+            with scope._lock:
+                value = scope.macros.get(name)
+                if value is None:
+                    value = scope.macros[name] = self.macro_defs[name]()
+        return value
+
+    def expand_macro(self, macro_class, macro_name, macro_args):
+        if macro_class == 'task':
+            task_name = macro_name
+            key = macro_args[0]
+            expanded = self.values[task_name][key]
+        elif macro_class == 'general':
+            expanded = self.general_macro(macro_name, macro_args[0] if macro_args else 'routine')
         else:
-            self.values[task.name] = {key: value}        
+            raise ValueError('unrecognized macro class: ' + macro_class)
+        return expanded if isinstance(expanded, basestring) else str(expanded)
 
     def expand_macros(self, string):
-        log('expanding string: ' + string, 2)
-        res = string
-        matcher = re.compile(r'<\w+:[\w\:]+>')
-        for macro in matcher.findall(string):
-            log('replacing macro ' + macro, 2)
-            # strip < and > and turn into array
-            macro_chunks = macro[1:-1].split(':')
-            # first field is macro class
-            macro_class = macro_chunks[0]
-            # second field is macro name
-            macro_name = macro_chunks[1]
-            # rest of fields are macro args
-            macro_args = macro_chunks[2:]
-            if macro_class == 'task':
-                task_name = macro_name
-                key = macro_args[0]
-                expanded = self.values[task_name][key]
-            elif macro_class == 'general':
-                try:
-                    expanded = self.values['cached'][macro_name]
-                except KeyError:
-                    expanded = self.macro_defs[macro_name]()
-                    self.values['cached'][macro_name] = expanded
-            log('expanding macro to: ' + expanded, 2)
-            res = res.replace(macro, expanded)
-        log('string expanded to: ' + res, 2)
-        return res
+        return Template(string).render(self)
+
+class Runtime(Scope):
+    """The routine scope of a run, holding what every scope of the run shares
+
+    Tasks and instances may run concurrently. Saving a value builds a new
+    snapshot under a lock and swaps it in, so expanding <task:name:key>
+    macros never locks, and a snapshot that has been read never changes.
+    """
+
+    def __init__(self, docker_client=None):
+        self.docker_client = docker_client
+        Scope.__init__(self, self, 'routine', None)
+        self.snapshot = {}
+        self._helpers = {}  # host name -> RestHelper
+        self._shared_lock = threading.Lock()
+
+    def save(self, task, key, value):
+        log('saving value ' + str(value) + ' for key ' + key + ' for task ' + task.name)
+        with self._shared_lock:
+            saved = dict(self.snapshot.get(task.name, {}))
+            saved[key] = value
+            snapshot = dict(self.snapshot)
+            snapshot[task.name] = saved
+            self.snapshot = snapshot
+
+    def get_rest_helper(self, host):
+        helper = self._helpers.get(host.name)
+        if helper is None:
+            with self._shared_lock:
+                helper = self._helpers.get(host.name)
+                if helper is None:
+                    hostname = host.cfg['hostname']
+                    port = host.cfg.get('port', None)
+                    secure = host.cfg.get('secure', False)
+                    check_cert = host.cfg.get('check-cert', True)
+                    helper = self._helpers[host.name] = ss_utils.RestHelper(hostname, port, secure, check_cert=check_cert)
+        return helper
+
+# load testing
+
+class LoadTest(object):
+    """Replays a routine against a host set at a target rate, or from a number of concurrent runners
+
+    With a rate, arrivals are open-loop: runs of the routine are scheduled at
+    fixed times however long earlier runs take, and their latency counts from
+    the scheduled time, so a slow target shows up as queueing rather than as
+    fewer, faster samples (coordinated omission). The rate, or the number of
+    runners, ramps up linearly over the first ramp_up seconds.
+    """
+
+    def __init__(self, routine, host_set, rate=None, concurrency=None, duration=60, ramp_up=0, max_workers=200, report_every=5):
+        if (rate is None) == (concurrency is None):
+            raise ValueError('a load test takes either a rate or a concurrency')
+        self.routine = routine
+        self.host_set = host_set
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.ramp_up = min(ramp_up, duration)
+        self.workers = concurrency if rate is None else max_workers
+        self.report_every = report_every
+        self._lock = threading.Lock()
+        self.latency = ss_utils.Histogram()     # microseconds from when each run was due
+        self.service = ss_utils.Histogram()     # microseconds from when each run started
+        self.recent = ss_utils.Histogram()      # latency since the last report
+        self.tasks = {}                         # task name -> (results by name, Histogram of durations)
+        self.runs, self.failed, self.recent_failed, self.max_backlog = 0, 0, 0, 0
+        self._arrivals = Queue.Queue()
+
+    def arrival(self, k):
+        """Seconds after the start the k-th run is due, with the rate ramping up from 0"""
+        ramp_runs = self.rate * self.ramp_up / 2.0
+        if k < ramp_runs:
+            return math.sqrt(2.0 * k * self.ramp_up / self.rate)
+        return self.ramp_up + (k - ramp_runs) / self.rate
+
+    def run_once(self, due):
+        start = ss_utils.monotonic()
+        res = Runner(self.routine, self.host_set).run()
+        end = ss_utils.monotonic()
+        with self._lock:
+            self.runs += 1
+            if res['tasks-failed']:
+                self.failed += 1
+                self.recent_failed += 1
+            self.latency.record((end - due) * 1000000)
+            self.recent.record((end - due) * 1000000)
+            self.service.record((end - start) * 1000000)
+            for task in res['task-results']:
+                results, durations = self.tasks.setdefault(task['name'], ({}, ss_utils.Histogram()))
+                results[task['result']] = results.get(task['result'], 0) + 1
+                if task['task-duration-ms'] != 'N/A':
+                    durations.record(task['task-duration-ms'] * 1000)
+
+    def _work(self):
+        while 1:
+            due = self._arrivals.get()
+            if due is None:
+                return
+            self.run_once(due)
+
+    def _dispatch(self):
+        k = 0
+        while 1:
+            due = self.start + self.arrival(k)
+            if due >= self.end:
+                break
+            delay = due - ss_utils.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._arrivals.put(due)
+            k += 1
+        for i in range(self.workers):
+            self._arrivals.put(None)
+
+    def _run_closed(self, i):
+        # runner i joins once its share of the ramp up has passed
+        delay = self.start + self.ramp_up * i / float(self.concurrency) - ss_utils.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        while ss_utils.monotonic() < self.end:
+            self.run_once(ss_utils.monotonic())
+
+    def report(self, last_runs, seconds):
+        """Write a line of live stats for the last seconds to stderr"""
+        with self._lock:
+            recent, self.recent = self.recent, ss_utils.Histogram()
+            failed, self.recent_failed = self.recent_failed, 0
+            runs = self.runs
+            backlog = self._arrivals.qsize()
+            self.max_backlog = max(self.max_backlog, backlog)
+        summary = recent.summary(scale=1000) or {'p50': 0, 'p90': 0, 'p99': 0}
+        sys.stderr.write('%7.1fs  %7.1f runs/s  p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  failed %d  backlog %d\n' % (
+            ss_utils.monotonic() - self.start, (runs - last_runs) / seconds, summary['p50'], summary['p90'], summary['p99'], failed, backlog))
+        return runs
+
+    def run(self):
+        """Run the load test, reporting as it goes, and return a summary"""
+        # keep a connection per worker alive between runs
+        ss_utils.CONNECTION_POOL.max_idle = max(ss_utils.CONNECTION_POOL.max_idle, self.workers)
+        # and let every worker run its tasks and instances without waiting on the shared pools
+        TASK_POOL.size = max(TASK_POOL.size, self.workers * self.routine.parallelism)
+        INSTANCE_POOL.size = max(INSTANCE_POOL.size, self.workers * max([ task.concurrency for task in self.routine.tasks ] or [1]))
+        self.start = ss_utils.monotonic()
+        self.end = self.start + self.duration
+        if self.rate is not None:
+            threads = [ threading.Thread(target=self._work, name='load-' + str(i)) for i in range(self.workers) ]
+            threads.append(threading.Thread(target=self._dispatch, name='arrivals'))
+        else:
+            threads = [ threading.Thread(target=self._run_closed, args=(i,), name='load-' + str(i)) for i in range(self.concurrency) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        runs = 0
+        last = self.start
+        while any([ t.is_alive() for t in threads ]):
+            time.sleep(0.2)
+            now = ss_utils.monotonic()
+            if now - last >= self.report_every:
+                runs = self.report(runs, now - last)
+                last = now
+        return self.summary(ss_utils.monotonic() - self.start)
+
+    def summary(self, elapsed):
+        return {
+            'routine': self.routine.name,
+            'host-set': self.host_set.name,
+            'mode': 'rate' if self.rate is not None else 'concurrency',
+            'target-rate': self.rate,
+            'concurrency': self.concurrency,
+            'duration-sec': self.duration,
+            'ramp-up-sec': self.ramp_up,
+            'elapsed-sec': round(elapsed, 3),
+            'runs': self.runs,
+            'runs-failed': self.failed,
+            'throughput-per-sec': round(self.runs / elapsed, 3),
+            'max-backlog': self.max_backlog,
+            'latency-ms': self.latency.summary(scale=1000, percentiles=(50, 90, 99, 99.9)),
+            'service-time-ms': self.service.summary(scale=1000, percentiles=(50, 90, 99, 99.9)),
+            'tasks': dict([ (name, {'results': results, 'duration-ms': durations.summary(scale=1000)}) for name, (results, durations) in self.tasks.items() ])
+            }
 
 if __name__ == '__main__':
 
-    routine_cfg = json.load(open(sys.argv[1]))
-    host_set_cfg = json.load(open(sys.argv[2]))
+    parser = argparse.ArgumentParser(description='run a routine against a host set once, or load test it with --rate or --concurrency')
+    parser.add_argument('routine', help='routine config file')
+    parser.add_argument('host_set', help='host set config file')
+    parser.add_argument('--rate', type=float, help='routine runs started per second, open-loop')
+    parser.add_argument('--concurrency', type=int, help='routines run back to back by this many runners')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to load test for')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds over which the rate or concurrency ramps up')
+    parser.add_argument('--max-workers', type=int, default=200, help='routines run at once in rate mode')
+    parser.add_argument('--report-every', type=float, default=5, help='seconds between live stats')
+    parser.add_argument('--output', help='write the load test summary here as well as to stdout')
+    args = parser.parse_args()
+
+    routine_cfg = json.load(open(args.routine))
+    host_set_cfg = json.load(open(args.host_set))
     routine = Routine(routine_cfg)
     host_set = HostSet(host_set_cfg)
-    res = Runner(routine, host_set).run()
-    print(json.dumps(res, indent=4))
-    sys.exit(res['tasks-failed'])
+    if args.rate is None and args.concurrency is None:
+        res = Runner(routine, host_set).run()
+        print(json.dumps(res, indent=4))
+        sys.exit(res['tasks-failed'])
+
+    # per task logging would swamp the live stats
+    LOG_LEVEL = 0
+    load_test = LoadTest(routine, host_set, rate=args.rate, concurrency=args.concurrency, duration=args.duration,
+                         ramp_up=args.ramp_up, max_workers=args.max_workers, report_every=args.report_every)
+    res = json.dumps(load_test.run(), indent=4)
+    print(res)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(res + '\n')
+    sys.exit(1 if load_test.failed else 0)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+# python -m unittest discover tests
+
+import sys
+import os
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'lib'))
+sys.path.append(os.path.join(ROOT, 'bench'))
+sys.path.append(ROOT)
+import json
+import types
+import threading
+import unittest
+import ss_utils
+import standins
+
+# monitor_agent talks to docker through the stand-in client, like bench/agent_bench.py
+docker = types.ModuleType('docker')
+docker.client = types.ModuleType('docker.client')
+docker.client.Client = standins.FakeDockerClient
+sys.modules.setdefault('docker', docker)
+sys.modules.setdefault('docker.client', docker.client)
+import monitor_agent as ma
+
+class StubResponse(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self, *args):
+        return self.body
+
+class StubServer(object):
+    """The /clients calls of a sensu-style server, kept in memory"""
+
+    def __init__(self):
+        self.clients = {}
+        self.calls = []
+
+    def request(self, method, uri, data=None):
+        self.calls.append((method, uri))
+        if method == 'GET':
+            return StubResponse(200, json.dumps(self.clients.values()))
+        if method == 'POST' and uri == '/clients':
+            client = json.loads(data)
+            self.clients[client['name']] = client
+            return StubResponse(201, '{}')
+        if method == 'DELETE':
+            self.clients.pop(uri.split('/')[-1], None)
+            return StubResponse(202, '{}')
+        return StubResponse(202, '{}')
+
+def new_event(action, container_id, **attributes):
+    return {'Type': 'container', 'Action': action, 'Actor': {'ID': container_id, 'Attributes': attributes}}
+
+def old_event(status, container_id):
+    return {'status': status, 'id': container_id}
+
+class EventsTest(unittest.TestCase):
+
+    def setUp(self):
+        ma.log = ma.debug = lambda msg: None
+        ma.CLI = standins.FakeDockerClient()
+        ma.server_conn = StubServer()
+        ma.HOSTNAME = 'test-host'
+        ma.ENV = 'test'
+        ma.CFG = {'frequencies': [{'pattern': 'skip-.*', 'seconds': None}, {'pattern': '.*', 'seconds': 10}]}
+        ma.FREQUENCIES = ma.FrequencyRules(ma.CFG['frequencies'])
+        ma.CONTAINERS_LOCK = threading.RLock()
+        ma.CONTAINER_IDS = {}
+        ma.ROUTINE_CACHE = ma.RoutineCache(lambda container_obj: None)
+        ma.BREAKER = ss_utils.CircuitBreaker()
+        ma.REPORTER = None
+        # never started, so no check runs
+        ma.SCHEDULER = ss_utils.Scheduler(workers=1)
+
+    def start(self, container_id, name):
+        ma.CLI.running[container_id] = name
+
+    def assertChecked(self, names):
+        self.assertEqual(sorted(ma.SCHEDULER._tasks.keys()), sorted(names))
+        self.assertEqual(sorted(ma.server_conn.clients.keys()), sorted(names))
+
+    def test_start_die_destroy(self):
+        self.start('1', 'web')
+        self.start('2', 'db')
+        ma.handle_events([new_event('start', '1', name='web'), old_event('start', '2')])
+        self.assertChecked(['web', 'db'])
+        self.assertEqual(ma.CONTAINER_IDS, {'1': 'web', '2': 'db'})
+
+        del ma.CLI.running['1']
+        ma.handle_events([new_event('die', '1', name='web'), new_event('destroy', '1', name='web')])
+        self.assertChecked(['db'])
+        # a stopped container keeps its client until it is destroyed
+        del ma.CLI.running['2']
+        ma.handle_events([old_event('die', '2')])
+        self.assertEqual(ma.SCHEDULER._tasks.keys(), [])
+        self.assertEqual(ma.server_conn.clients.keys(), ['db'])
+        ma.handle_events([old_event('destroy', '2')])
+        self.assertChecked([])
+        self.assertEqual(ma.CONTAINER_IDS, {})
+
+    def test_restart(self):
+        self.start('1', 'web')
+        ma.handle_events([new_event('start', '1'), new_event('die', '1'), new_event('start', '1')])
+        self.assertChecked(['web'])
+        # the client is neither deleted nor posted again
+        self.assertEqual(ma.server_conn.calls, [('POST', '/clients')])
+
+    def test_rename(self):
+        self.start('1', 'web')
+        self.start('2', 'db')
+        ma.handle_events([new_event('start', '1'), old_event('start', '2')])
+        ma.CLI.running['1'] = 'web-blue'
+        ma.CLI.running['2'] = 'db-blue'
+        ma.handle_events([new_event('rename', '1', name='web-blue', oldName='/web'), old_event('rename', '2')])
+        self.assertChecked(['web-blue', 'db-blue'])
+        self.assertEqual(ma.CONTAINER_IDS, {'1': 'web-blue', '2': 'db-blue'})
+
+    def test_rename_of_unknown_container(self):
+        # the agent missed the start, e.g. while the event stream was reconnecting
+        self.start('1', 'web-blue')
+        ma.handle_events([new_event('rename', '1', name='web-blue', oldName='/web')])
+        self.assertChecked(['web-blue'])
+
+    def test_ignored_events(self):
+        self.start('1', 'web')
+        self.start('2', 'skip-me')
+        ma.handle_events([
+            new_event('pause', '1'),
+            {'Type': 'network', 'Action': 'start', 'Actor': {'ID': '1'}},
+            old_event('start', '2')
+            ])
+        self.assertChecked([])
+
+    def test_bad_event_does_not_stop_the_stream(self):
+        self.start('1', 'web')
+        ma.handle_events([{'Type': 'container', 'Action': 'start'}, new_event('start', '1')])
+        self.assertChecked(['web'])
+
+if __name__ == '__main__':
+    unittest.main()
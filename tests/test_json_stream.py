@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+# python -m unittest discover tests
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import json
+import random
+import unittest
+import StringIO
+import ss_utils
+
+class JsonExtractorChunksTest(unittest.TestCase):
+
+    def extract(self, doc, paths, chunk_size):
+        return ss_utils.JsonExtractor(paths).extract(StringIO.StringIO(doc).read, chunk_size=chunk_size)
+
+    def test_numbers_split_across_chunks(self):
+        # floats and exponents cut after '1.' or '1e' by a chunk boundary must not be read as 1
+        rand = random.Random(0)
+        metrics = dict([ ('m%04d' % i, rand.choice([rand.random() * 1000, rand.randint(-10 ** 6, 10 ** 6), 1.5e-7, -2E+12]))
+                         for i in range(3000) ])
+        metrics['zzz'] = 12.75
+        doc = json.dumps({'metrics': metrics, 'status': 'ok', 'last': 3.25e10})
+        paths = ['metrics/zzz', 'status', 'last', 'metrics/m0001']
+        expected = {'metrics/zzz': 12.75, 'status': 'ok', 'last': 3.25e10, 'metrics/m0001': metrics['m0001']}
+        for chunk_size in (16384, 3, 2, 1):
+            self.assertEqual(self.extract(doc, paths, chunk_size), expected)
+
+    def test_number_at_end_of_document(self):
+        for chunk_size in (16384, 3, 2, 1):
+            self.assertEqual(self.extract('{"a": [1.5e3, -0.25]}', ['a/0', 'a/1'], chunk_size), {'a/0': 1500.0, 'a/1': -0.25})
+            self.assertEqual(self.extract('{"a": {"b": 1e2}}', ['a/b'], chunk_size), {'a/b': 100.0})
+
+    def test_wildcard_values_across_chunks(self):
+        doc = json.dumps({'items': [ {'id': i, 'load': i + 0.5} for i in range(200) ]})
+        for chunk_size in (16384, 3, 2, 1):
+            self.assertEqual(self.extract(doc, ['items/*/load'], chunk_size), {'items/*/load': [ i + 0.5 for i in range(200) ]})
+
+    def test_negative_index(self):
+        doc = json.dumps({'items': [ {'id': i} for i in range(50) ], 'other': 1})
+        for chunk_size in (16384, 3, 2, 1):
+            self.assertEqual(self.extract(doc, ['items/-1/id', 'items/0/id', 'items/-51/id'], chunk_size), {'items/-1/id': 49, 'items/0/id': 0})
+        self.assertEqual(ss_utils.compile_xpath('items/-2/id').get(json.loads(doc)), 48)
+        self.assertTrue(ss_utils.compile_xpath('items/-51/id').get(json.loads(doc)) is ss_utils.MISSING)
+
+if __name__ == '__main__':
+    unittest.main()